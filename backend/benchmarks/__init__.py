@@ -0,0 +1,52 @@
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+@contextmanager
+def count_queries(engine):
+    """Count the statements executed on `engine` within the block."""
+    counter = QueryCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
+
+
+def report(label: str, timings: list[float], queries: int | None = None) -> None:
+    timings = sorted(timings)
+    mean = sum(timings) / len(timings)
+    p99 = timings[min(len(timings) - 1, round(0.99 * (len(timings) - 1)))]
+    line = f"{label:<24} mean {mean * 1000:>9.2f} ms   p99 {p99 * 1000:>9.2f} ms"
+    if queries is not None:
+        line += f"   {queries} queries"
+    print(line)
+
+
+def measure(fn, iterations: int) -> list[float]:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def measure_async(fn, iterations: int) -> list[float]:
+    """Like `measure`, for a coroutine function, all in the running loop."""
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn()
+        timings.append(time.perf_counter() - start)
+    return timings
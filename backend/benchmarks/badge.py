@@ -0,0 +1,54 @@
+"""Benchmark the badge endpoint with and without the badge cache.
+
+    cd backend
+    python -m benchmarks.badge --owner nixos --repo nixpkgs
+
+Compares a cold cache (a query and a fresh SVG on every hit), a warm cache,
+and conditional requests answered with 304 Not Modified. All iterations run
+in one event loop, like requests in the app.
+"""
+
+import argparse
+import asyncio
+
+from sqlmodel import Session
+
+from benchmarks import count_queries, measure_async, report
+from flakestry.api.flake import badge
+from flakestry.cache import badge_cache
+from flakestry.concurrency import ThreadpoolProxy
+from flakestry.sql import engine
+
+
+async def main(args: argparse.Namespace) -> None:
+    session = ThreadpoolProxy(Session(engine))
+
+    async def request(if_none_match=None):
+        return await badge(args.owner, args.repo, if_none_match, None, session)
+
+    etag = (await request()).headers["ETag"]
+
+    async def cold():
+        badge_cache.clear()
+        await request()
+
+    async def warm():
+        await request()
+
+    async def conditional():
+        await request(etag)
+
+    for label, fn in [("uncached", cold), ("cached", warm), ("304", conditional)]:
+        with count_queries(engine) as counter:
+            await fn()
+        timings = await measure_async(fn, args.iterations)
+        report(label, timings, counter.count)
+        print(f"{'':<24} {len(timings) / sum(timings):.0f} badges/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--owner", default="nixos")
+    parser.add_argument("--repo", default="nixpkgs")
+    parser.add_argument("--iterations", type=int, default=1000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,91 @@
+"""HTTP load benchmark for the flake read API.
+
+Start the backend once per configuration and point the benchmark at it:
+
+    FLAKESTRY_ASYNC_IO=false uvicorn --app-dir backend flakestry.main:app --port 8000
+    FLAKESTRY_ASYNC_IO=true uvicorn --app-dir backend flakestry.main:app --port 8001
+
+    cd backend
+    python -m benchmarks.load --url http://localhost:8000 --label sync
+    python -m benchmarks.load --url http://localhost:8001 --label async
+
+Reports requests/sec and latency percentiles per path.
+"""
+
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+DEFAULT_PATHS = [
+    "/flake",
+    "/flake?q=nixpkgs",
+    "/flake/github/nixos",
+    "/flake/github/nixos/nixpkgs",
+    "/flake/github/nixos/nixpkgs/23.05",
+    "/badge/flake/github/nixos/nixpkgs",
+]
+
+
+def percentile(samples: list[float], p: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+    return samples[index]
+
+
+async def run_path(
+    http: aiohttp.ClientSession, url: str, concurrency: int, duration: float
+) -> tuple[list[float], int]:
+    latencies: list[float] = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                async with http.get(url) as response:
+                    await response.read()
+                    if response.status >= 400:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+async def main(args: argparse.Namespace) -> None:
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as http:
+        print(
+            f"{'label':<8} {'path':<40} {'req/s':>9} {'p50 ms':>8} "
+            f"{'p99 ms':>8} {'errors':>6}"
+        )
+        for path in args.paths or DEFAULT_PATHS:
+            url = args.url.rstrip("/") + path
+            # Warm up connections and caches
+            await run_path(http, url, args.concurrency, 1)
+            latencies, errors = await run_path(
+                http, url, args.concurrency, args.duration
+            )
+            print(
+                f"{args.label:<8} {path:<40} {len(latencies) / args.duration:>9.1f} "
+                f"{percentile(latencies, 50) * 1000:>8.1f} "
+                f"{percentile(latencies, 99) * 1000:>8.1f} {errors:>6}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("paths", nargs="*", help="Paths to benchmark")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,86 @@
+"""Check that concurrent publishes for a new owner don't race.
+
+Sends --publishes concurrent POST /publish requests for one new
+repository, spread over --versions versions, then asserts that there is
+exactly one owner and one repository, and that each version was created
+once (201) with every other request rejected (409). GitHub and the OIDC
+token are faked; the database is the configured Postgres:
+
+    cd backend
+    FLAKESTRY_JOB_WORKER=false python -m benchmarks.publish --publishes 40 --versions 5
+"""
+
+import argparse
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+import flakestry.api.publish
+from benchmarks import count_queries
+from flakestry.main import app
+from flakestry.oidc import authenticate_user
+from flakestry.sql import GitHubOwner, GitHubRepo, Release, engine
+
+
+class FakeGitHub:
+    def commit(self, owner: str, repo: str, ref: str, token: str) -> dict:
+        return {
+            "sha": "0" * 40,
+            "commit": {"committer": {"date": "2023-10-26T12:34:56Z"}},
+        }
+
+
+def main(args: argparse.Namespace) -> None:
+    owner_name = f"race-{uuid.uuid4().hex[:8]}"
+    flakestry.api.publish.get_github = FakeGitHub
+    app.dependency_overrides[authenticate_user] = lambda: SimpleNamespace(
+        repository=f"{owner_name}/repo"
+    )
+
+    with TestClient(app) as client:
+
+        def publish(i: int) -> int:
+            response = client.post(
+                "/publish",
+                json={"version": f"1.0.{i % args.versions}"},
+                headers={"github-token": "token"},
+            )
+            return response.status_code
+
+        with count_queries(engine) as counter:
+            with ThreadPoolExecutor(args.concurrency) as executor:
+                statuses = Counter(executor.map(publish, range(args.publishes)))
+
+    print(f"{owner_name}: {dict(statuses)}   {counter.count} queries")
+    assert statuses == {
+        201: args.versions,
+        409: args.publishes - args.versions,
+    }, statuses
+
+    with Session(engine) as session:
+        owners = session.exec(
+            select(GitHubOwner).where(GitHubOwner.name == owner_name)
+        ).all()
+        assert len(owners) == 1, owners
+        repos = session.exec(
+            select(GitHubRepo).where(GitHubRepo.owner_id == owners[0].id)
+        ).all()
+        assert len(repos) == 1, repos
+        versions = session.exec(
+            select(Release.version).where(Release.repo_id == repos[0].id)
+        ).all()
+        assert sorted(versions) == sorted(
+            f"1.0.{v}" for v in range(args.versions)
+        ), versions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--publishes", type=int, default=40)
+    parser.add_argument("--versions", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=20)
+    main(parser.parse_args())
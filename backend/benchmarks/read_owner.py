@@ -0,0 +1,104 @@
+"""Benchmark read_owner on a large synthetic owner.
+
+Creates an owner with many repos and releases (once) and compares the
+previous N+1 strategy with the single "latest release per repo" query.
+Every third repo publishes per commit, with the default v0.1.{datetime}
+versions:
+
+    cd backend
+    python -m benchmarks.read_owner --repos 500 --releases 20
+"""
+
+import argparse
+import asyncio
+
+from packaging.version import parse
+from sqlmodel import Session, select
+
+from benchmarks import count_queries, measure, report
+from flakestry.api.flake import read_owner
+from flakestry.concurrency import ThreadpoolProxy
+from flakestry.sql import (
+    GitHubOwner,
+    GitHubRepo,
+    Release,
+    create_db_and_tables,
+    engine,
+)
+
+
+def seed(session: Session, owner_name: str, repos: int, releases: int) -> None:
+    if session.exec(select(GitHubOwner).where(GitHubOwner.name == owner_name)).first():
+        return
+
+    owner = GitHubOwner(name=owner_name)
+    session.add(owner)
+    for r in range(repos):
+        repo = GitHubRepo(name=f"repo-{r}", description="synthetic", owner=owner)
+        session.add(repo)
+        for v in range(releases):
+            if r % 3 == 0:
+                version = f"0.1.{20231026123456 + v}"
+            else:
+                version = f"{v // 10}.{v % 10}.{r % 3}"
+            session.add(
+                Release(
+                    repo=repo,
+                    version=version,
+                    commit="0" * 40,
+                    description="synthetic",
+                    readme="# synthetic\n" * 200,
+                    outputs={"packages": {"x86_64-linux": {"default": {}}}},
+                )
+            )
+    session.commit()
+
+
+def read_owner_n_plus_one(session: Session, owner_name: str) -> list[Release]:
+    repos = session.exec(
+        select(GitHubRepo)
+        .join(GitHubOwner)
+        .where(GitHubOwner.name == owner_name)
+        .order_by(GitHubRepo.created_at.desc())
+    ).all()
+    latest = []
+    for repo in repos:
+        releases = sorted(repo.releases, key=lambda r: parse(r.version))
+        if releases:
+            latest.append(releases[-1])
+    return latest
+
+
+def main(args: argparse.Namespace) -> None:
+    create_db_and_tables()
+    owner_name = f"bench-{args.repos}x{args.releases}-per-commit"
+    with Session(engine) as session:
+        seed(session, owner_name, args.repos, args.releases)
+
+    def n_plus_one():
+        with Session(engine) as session:
+            read_owner_n_plus_one(session, owner_name)
+
+    def single_query():
+        with Session(engine) as session:
+            asyncio.run(read_owner(owner_name, ThreadpoolProxy(session)))
+
+    with Session(engine) as session:
+        expected = {
+            (r.repo.name, r.version) for r in read_owner_n_plus_one(session, owner_name)
+        }
+        latest = asyncio.run(read_owner(owner_name, ThreadpoolProxy(session)))
+        assert {(r.repo, r.version) for r in latest["repos"]} == expected
+
+    for label, fn in [("n+1", n_plus_one), ("latest per repo", single_query)]:
+        with count_queries(engine) as counter:
+            fn()
+        report(label, measure(fn, args.iterations), counter.count)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repos", type=int, default=500)
+    parser.add_argument("--releases", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=20)
+    main(parser.parse_args())
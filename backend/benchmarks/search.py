@@ -0,0 +1,116 @@
+"""Search latency on a synthetic corpus.
+
+Loads the same synthetic releases into an index with the explicit mapping
+from flakestry.search and into one with dynamic mapping and `outputs`
+indexed as a Python repr (the previous layout), then compares latencies:
+
+    cd backend
+    python -m benchmarks.search --releases 100000
+
+The benchmark indices are kept between runs, pass --reload to rebuild them.
+"""
+
+import argparse
+import random
+import time
+
+from opensearchpy import helpers
+
+from benchmarks import report, synthetic
+from flakestry.indexer import output_names
+from flakestry.search import (
+    get_opensearch,
+    opensearch_analysis,
+    opensearch_mappings,
+    search_query,
+)
+
+QUERIES = ["home-manager", "nixpkgs", "rust", "neovim plugin", "hom", "pyhton"]
+
+LEGACY_QUERY_FIELDS = ["description^2", "readme", "outputs", "repo^2", "owner^2"]
+
+
+def documents(count: int, legacy: bool):
+    rng = random.Random(0)
+    owners = [synthetic.name(rng) for _ in range(max(1, count // 20))]
+    for id in range(count):
+        outputs = synthetic.outputs(rng, rng.randint(1, 30))
+        yield {
+            "_id": id,
+            "_source": {
+                "owner": rng.choice(owners),
+                "repo": synthetic.name(rng),
+                "description": synthetic.sentence(rng, 8),
+                "readme": synthetic.readme(rng, rng.randint(1, 10)),
+                "outputs": str(outputs) if legacy else output_names(outputs),
+            },
+        }
+
+
+def load(opensearch, index: str, count: int, legacy: bool, reload: bool):
+    if opensearch.indices.exists(index=index):
+        if not reload:
+            return
+        opensearch.indices.delete(index=index)
+
+    body = {"settings": {"index": {"refresh_interval": "-1"}}}
+    if not legacy:
+        body["settings"]["index"]["analysis"] = opensearch_analysis
+        body["mappings"] = opensearch_mappings
+    opensearch.indices.create(index, body=body)
+
+    start = time.perf_counter()
+    helpers.bulk(
+        opensearch,
+        ({"_index": index, **doc} for doc in documents(count, legacy)),
+        chunk_size=1000,
+        request_timeout=120,
+    )
+    opensearch.indices.refresh(index=index)
+    opensearch.indices.forcemerge(index=index, max_num_segments=1, request_timeout=600)
+    print(f"loaded {index} in {time.perf_counter() - start:.1f}s")
+
+
+def main(args: argparse.Namespace) -> None:
+    opensearch = get_opensearch()
+    indices = {
+        "legacy": f"bench-flakes-legacy-{args.releases}",
+        "explicit": f"bench-flakes-explicit-{args.releases}",
+    }
+    for layout, index in indices.items():
+        load(opensearch, index, args.releases, layout == "legacy", args.reload)
+        stats = opensearch.indices.stats(index=index, metric="store")
+        size = stats["_all"]["primaries"]["store"]["size_in_bytes"]
+        print(f"{index}: {size / 2**20:.1f} MiB")
+
+    for q in args.queries or QUERIES:
+        for layout, index in indices.items():
+            if layout == "legacy":
+                query = {
+                    "multi_match": {
+                        "query": q,
+                        "fuzziness": "AUTO",
+                        "fields": LEGACY_QUERY_FIELDS,
+                    }
+                }
+            else:
+                query = search_query(q)
+            timings = []
+            for _ in range(args.iterations):
+                start = time.perf_counter()
+                opensearch.search(
+                    index=index,
+                    body={"size": 10, "query": query},
+                    request_cache=False,
+                )
+                timings.append(time.perf_counter() - start)
+            report(f"{layout} {q!r}", timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--releases", type=int, default=100_000)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--reload", action="store_true")
+    parser.add_argument("queries", nargs="*")
+    main(parser.parse_args())
@@ -0,0 +1,59 @@
+"""Benchmark serializing a release with large outputs.
+
+    cd backend
+    python -m benchmarks.serialize --packages 5000
+
+Compares FastAPI's default path for `read_version` (validating against
+`response_model`, `jsonable_encoder` and the stdlib json encoder) with the
+orjson response it now returns.
+"""
+
+import argparse
+import asyncio
+import random
+from datetime import datetime
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from benchmarks import measure, report
+from benchmarks.synthetic import outputs, readme
+from flakestry.sql import Release
+
+
+def main(args: argparse.Namespace) -> None:
+    rng = random.Random(0)
+    release = Release(
+        id=1,
+        repo_id=1,
+        version="23.11.0",
+        version_key=[23, 11],
+        commit="0" * 40,
+        description="A large flake",
+        created_at=datetime.utcnow(),
+        readme=readme(rng, 200),
+        meta_data={"locks": {"nodes": {}}},
+        outputs=outputs(rng, args.packages),
+    )
+    field = create_response_field("Release", Release)
+
+    def default():
+        content = asyncio.run(serialize_response(field=field, response_content=release))
+        return JSONResponse(content).body
+
+    def fast():
+        return ORJSONResponse(
+            {name: getattr(release, name) for name in Release.__fields__}
+        ).body
+
+    print(f"{len(fast()) / 1024:.0f} KiB response")
+    for label, fn in [("response_model + json", default), ("orjson", fast)]:
+        report(label, measure(fn, args.iterations))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packages", type=int, default=5000)
+    parser.add_argument("--iterations", type=int, default=50)
+    main(parser.parse_args())
@@ -0,0 +1,40 @@
+"""Benchmark app startup with and without schema creation.
+
+    cd backend
+    FLAKESTRY_JOB_WORKER=false python -m benchmarks.startup
+
+Startup used to run `create_all` and the migrations on every boot. Each
+iteration starts from a fresh connection pool, as a new worker would.
+"""
+
+import argparse
+
+from fastapi.testclient import TestClient
+
+from benchmarks import count_queries, measure, report
+from flakestry.main import app
+from flakestry.migrations import migrate
+from flakestry.sql import engine
+
+
+def main(args: argparse.Namespace) -> None:
+    def startup():
+        engine.dispose()
+        with TestClient(app):
+            pass
+
+    def startup_with_ddl():
+        engine.dispose()
+        with TestClient(app):
+            migrate(engine)
+
+    for label, fn in [("create_all + migrate", startup_with_ddl), ("no DDL", startup)]:
+        with count_queries(engine) as counter:
+            fn()
+        report(label, measure(fn, args.iterations), counter.count)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    main(parser.parse_args())
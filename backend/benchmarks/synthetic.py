@@ -0,0 +1,131 @@
+"""Deterministic synthetic flakes for benchmarks."""
+
+from datetime import datetime, timedelta
+from typing import Any, Iterator
+import random
+
+from flakestry.readme import render_readme
+from flakestry.sql import GitHubOwner, GitHubRepo, Release
+
+WORDS = (
+    "nix flake home manager rust python haskell neovim emacs darwin linux "
+    "overlay module package shell cli tool server config build cache deploy "
+    "secret disk format lsp plugin theme font browser terminal editor wayland "
+    "container docker kubernetes database postgres monitoring backup network"
+).split()
+
+SYSTEMS = ["x86_64-linux", "aarch64-linux", "x86_64-darwin", "aarch64-darwin"]
+
+
+def name(rng: random.Random) -> str:
+    return "-".join(rng.sample(WORDS, rng.randint(1, 3)))
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def readme(rng: random.Random, paragraphs: int) -> str:
+    return "\n\n".join(
+        f"## {sentence(rng, 3)}\n\n{sentence(rng, rng.randint(20, 80))}"
+        for _ in range(paragraphs)
+    )
+
+
+def outputs(rng: random.Random, packages: int) -> dict[str, Any]:
+    """Flake outputs shaped like `nix flake show --json`."""
+    per_system = {
+        f"{name(rng)}-{i}": {
+            "name": f"{name(rng)}-{rng.randint(0, 9)}.{rng.randint(0, 99)}",
+            "type": "derivation",
+            "description": sentence(rng, 6),
+        }
+        for i in range(packages)
+    }
+    return {
+        "packages": {system: per_system for system in SYSTEMS},
+        "devShells": {
+            system: {"default": {"name": "nix-shell", "type": "derivation"}}
+            for system in SYSTEMS
+        },
+        "overlays": {"default": {"type": "nixpkgs-overlay"}},
+    }
+
+
+def count(rng: random.Random, mean: float) -> int:
+    """At least one, exponentially distributed around `mean`."""
+    if mean <= 1:
+        return 1
+    return 1 + int(rng.expovariate(1 / (mean - 1)))
+
+
+def versions(rng: random.Random, releases: int) -> Iterator[str]:
+    major, minor, patch = rng.randint(0, 3), rng.randint(0, 12), 0
+    for _ in range(releases):
+        bump = rng.random()
+        if bump < 0.05:
+            major, minor, patch = major + 1, 0, 0
+        elif bump < 0.3:
+            minor, patch = minor + 1, 0
+        else:
+            patch += 1
+        yield f"{major}.{minor}.{patch}"
+
+
+def corpus(
+    rng: random.Random,
+    owners: int,
+    repos_per_owner: float,
+    releases_per_repo: float,
+    max_packages: int,
+) -> Iterator[GitHubRepo]:
+    """Repositories with their releases, generated one at a time.
+
+    Repos and releases per repo are exponentially distributed around the
+    given means. Package counts are heavy-tailed, most flakes have a few
+    outputs and some have up to `max_packages` per system.
+    """
+    epoch = datetime(2021, 1, 1)
+    for i in range(owners):
+        owner_created_at = epoch + timedelta(days=rng.uniform(0, 1000))
+        owner = GitHubOwner(name=f"{name(rng)}-{i}", created_at=owner_created_at)
+        for j in range(count(rng, repos_per_owner)):
+            description = sentence(rng, rng.randint(4, 16))
+            created_at = owner_created_at + timedelta(days=rng.uniform(0, 100))
+            repo = GitHubRepo(
+                name=f"{name(rng)}-{j}",
+                description=description,
+                owner=owner,
+                created_at=created_at,
+            )
+            # READMEs rarely change between releases. Without links, the
+            # rendering doesn't depend on the commit either.
+            repo_readme = readme(rng, rng.randint(2, 20))
+            repo_readme_html = render_readme(repo_readme, "", "")
+            for version in versions(rng, count(rng, releases_per_repo)):
+                created_at += timedelta(hours=rng.uniform(1, 24 * 30))
+                commit = f"{rng.getrandbits(160):040x}"
+                has_readme = rng.random() < 0.8
+                packages = min(max_packages, int(rng.paretovariate(1.2) * 2))
+                Release(
+                    repo=repo,
+                    version=version,
+                    commit=commit,
+                    description=description,
+                    created_at=created_at,
+                    readme_filename="README.md" if has_readme else None,
+                    readme=repo_readme if has_readme else None,
+                    readme_html=repo_readme_html if has_readme else None,
+                    meta_data={
+                        "description": description,
+                        "lastModified": int(created_at.timestamp()),
+                        "locked": {
+                            "owner": owner.name,
+                            "repo": repo.name,
+                            "rev": commit,
+                            "type": "github",
+                        },
+                    },
+                    outputs=outputs(rng, packages),
+                )
+            yield repo
@@ -1,17 +1,36 @@
-from typing import List, Optional
-from fastapi import APIRouter, Depends, status
+from typing import Any, Callable, List, Optional, Sequence
+from fastapi import APIRouter, Depends, Header, Query, status
 from fastapi.exceptions import HTTPException
-from fastapi.responses import Response
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel
-from datetime import datetime
-from sqlmodel import Session, select, col
-from opensearchpy import OpenSearch
-from packaging.version import parse
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import base64
+import binascii
+import hashlib
+import json
+from sqlmodel import select, col
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import BigInteger, and_, func, literal, or_, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import load_only, undefer, undefer_group
+from opensearchpy import AsyncOpenSearch, NotFoundError, RequestError
 import anybadge
 
-from flakestry.sql import GitHubOwner, GitHubRepo, Release, get_session
+from flakestry.cache import badge_cache, badge_cache_ttl, search_cache
+from flakestry.suggest import suggester
+from flakestry.sql import GitHubOwner, GitHubRepo, Release, get_async_read_session
 from flakestry.error import ValidationError
-from flakestry.search import get_opensearch, opensearch_index
+from flakestry.search import (
+    get_async_opensearch,
+    opensearch_index,
+    search_pit_keep_alive,
+    search_query,
+    search_shallow_limit,
+    search_sort,
+    search_total_hits_threshold,
+)
 
 
 # A compact subset of a FlakeRelease for use in search results
@@ -25,13 +44,29 @@ class FlakeReleaseCompact(BaseModel):
 
 class FlakeRelease(FlakeReleaseCompact):
     commit: str
-    readme: str
+    # Not included in compact responses
+    readme: Optional[str] = None
+    # Sanitized HTML, missing until the README has been rendered
+    readme_html: Optional[str] = None
 
 
 class FlakesResponse(BaseModel):
     releases: List[FlakeReleaseCompact]
+    # Total number of results, counted up to a threshold
     count: int
+    count_is_lower_bound: bool = False
     query: Optional[str] = None
+    # Pass as `cursor` to fetch the next page
+    next_cursor: Optional[str] = None
+
+
+class Suggestion(BaseModel):
+    owner: str
+    repo: str
+
+
+class SuggestResponse(BaseModel):
+    suggestions: List[Suggestion]
 
 
 class OwnerResponse(BaseModel):
@@ -40,6 +75,8 @@ class OwnerResponse(BaseModel):
 
 class RepoResponse(BaseModel):
     releases: List[FlakeRelease]
+    # Pass as `cursor` to fetch the next page
+    next_cursor: Optional[str] = None
 
 
 router = APIRouter()
@@ -52,49 +89,183 @@ router = APIRouter()
         422: {"model": ValidationError},
     },
 )
-def get_flakes(
-    session: Session = Depends(get_session),
-    opensearch: OpenSearch = Depends(get_opensearch),
+async def get_flakes(
+    session: AsyncSession = Depends(get_async_read_session),
+    opensearch: AsyncOpenSearch = Depends(get_async_opensearch),
     q: Optional[str] = None,
+    offset: int = Query(default=0, ge=0, le=search_shallow_limit),
+    limit: int = Query(default=10, ge=1, le=100),
+    cursor: Optional[str] = None,
 ):
+    q = " ".join((q or "").lower().split()) or None
+    # Only pages reached by offset are cached, cursors embed a PIT id
+    key = None if cursor else (q, offset, limit)
+    if key is not None and (cached := search_cache.get(key)) is not None:
+        return cached
     if q:
-        response = opensearch.search(
-            body={
-                "size": 10,
-                "query": {
-                    "multi_match": {
-                        "query": q,
-                        "fuzziness": "AUTO",
-                        "fields": [
-                            "description^2",
-                            "readme",
-                            "outputs",
-                            "repo^2",
-                            "owner^2",
-                        ],
-                    }
-                },
-            },
-            index=opensearch_index,
+        response = await search_flakes(opensearch, session, q, offset, limit, cursor)
+    else:
+        response = await latest_flakes(session, offset, limit, cursor)
+    if key is not None:
+        search_cache.set(key, response)
+    return response
+
+
+async def search_flakes(
+    opensearch: AsyncOpenSearch,
+    session: AsyncSession,
+    q: str,
+    offset: int,
+    limit: int,
+    cursor: Optional[str],
+):
+    pit_id, search_after = None, None
+    if cursor:
+        offset, pit_id, search_after = decode_cursor(
+            cursor, 3, [is_offset, is_optional_str, is_search_after]
+        )
+
+    body: dict[str, Any] = {
+        "size": limit,
+        "query": search_query(q),
+        "sort": search_sort,
+        "track_total_hits": search_total_hits_threshold,
+        "_source": list(FlakeReleaseCompact.__fields__),
+    }
+    if not pit_id and offset + limit > search_shallow_limit:
+        # Continue deep pages in a point in time, so they stay consistent
+        pit = await opensearch.create_point_in_time(
+            index=opensearch_index, keep_alive=search_pit_keep_alive
+        )
+        pit_id = pit["pit_id"]
+    if pit_id:
+        body["pit"] = {"id": pit_id, "keep_alive": search_pit_keep_alive}
+        try:
+            response = await opensearch.search(
+                body={**body, "search_after": search_after} if search_after else body,
+                **({} if search_after else {"from_": offset}),
+            )
+        except (NotFoundError, RequestError):
+            if not cursor:
+                raise
+            # An expired or made up PIT, or an offset beyond the result window
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+            )
+    else:
+        response = await opensearch.search(
+            body=body, index=opensearch_index, from_=offset
         )
 
-        # A map of release ids to search scores
-        hits = dict(
-            [(int(hit["_id"]), hit["_score"]) for hit in response["hits"]["hits"]]
+    hits = response["hits"]["hits"]
+    total = response["hits"]["total"]
+    next_cursor = None
+    more = offset + limit < total["value"] or total["relation"] == "gte"
+    if len(hits) == limit and more:
+        next_cursor = encode_cursor(
+            offset + limit, pit_id, hits[-1]["sort"] if pit_id else None
         )
 
-        releases = session.exec(
-            select(Release).where(col(Release.id).in_(hits.keys()))
-        ).all()
-        # Sort the releases by their search score
-        releases.sort(key=lambda r: hits[r.id], reverse=True)
+    return {
+        "releases": await releases_from_hits(session, hits),
+        "count": total["value"],
+        "count_is_lower_bound": total["relation"] == "gte",
+        "query": q,
+        "next_cursor": next_cursor,
+    }
 
+
+async def latest_flakes(
+    session: AsyncSession, offset: int, limit: int, cursor: Optional[str]
+):
+    statement = (
+        select(Release)
+        .order_by(Release.created_at.desc(), Release.id.desc())
+        .limit(limit + 1)
+    )
+    if not cursor:
+        statement = statement.offset(offset)
     else:
-        statement = select(Release).order_by(Release.created_at.desc()).limit(10)
-        releases = session.exec(statement).all()
+        created_at, id = decode_cursor(cursor, 2, [is_str, is_id])
+        try:
+            created_at = datetime.fromisoformat(created_at)
+        except (TypeError, ValueError):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+            )
+        statement = statement.where(
+            tuple_(Release.created_at, Release.id)
+            < tuple_(literal(created_at), literal(id))
+        )
+    releases = (await session.exec(statement)).all()
+
+    next_cursor = None
+    if len(releases) > limit:
+        releases = releases[:limit]
+        last = releases[-1]
+        next_cursor = encode_cursor(last.created_at.isoformat(), last.id)
+
+    # Count like track_total_hits does for searches
+    count = (
+        await session.exec(
+            select(func.count()).select_from(
+                select(Release.id).limit(search_total_hits_threshold + 1).subquery()
+            )
+        )
+    ).one()
+
+    return {
+        "releases": list(map(toFlakeReleaseCompact, releases)),
+        "count": min(count, search_total_hits_threshold),
+        "count_is_lower_bound": count > search_total_hits_threshold,
+        "next_cursor": next_cursor,
+    }
+
+
+async def releases_from_hits(
+    session: AsyncSession, hits: list[dict[str, Any]]
+) -> list[FlakeReleaseCompact]:
+    """Build search results from the stored documents, in order of their score.
+
+    Documents indexed before they stored all compact fields are loaded from
+    Postgres instead."""
+    releases = {}
+    missing = []
+    for hit in hits:
+        source = hit["_source"]
+        if all(source.get(field) for field in ["owner", "repo", "version"]):
+            releases[int(hit["_id"])] = FlakeReleaseCompact(
+                **{**source, "description": source.get("description") or ""}
+            )
+        else:
+            missing.append(int(hit["_id"]))
+
+    if missing:
+        statement = select(Release).where(col(Release.id).in_(missing))
+        for release in (await session.exec(statement)).all():
+            releases[release.id] = toFlakeReleaseCompact(release)
+
+    return [releases[int(hit["_id"])] for hit in hits if int(hit["_id"]) in releases]
 
-    releases = list(map(toFlakeReleaseCompact, releases))
-    return {"releases": releases, "count": len(releases), "query": q}
+
+@router.get(
+    "/flake/suggest",
+    response_model=SuggestResponse,
+    responses={
+        422: {"model": ValidationError},
+    },
+)
+async def suggest_flakes(
+    q: str = Query(min_length=1, max_length=200),
+    limit: int = Query(default=10, ge=1, le=50),
+):
+    index = await suggester.get()
+    suggestions = index.search(" ".join(q.split()), limit)
+    return {
+        "suggestions": [
+            Suggestion(owner=owner, repo=repo) for owner, repo in suggestions
+        ]
+    }
 
 
 @router.get(
@@ -104,22 +275,26 @@ def get_flakes(
         422: {"model": ValidationError},
     },
 )
-def read_owner(owner: str, session: Session = Depends(get_session)):
-    # get all repos
-    q = (
-        select(GitHubRepo)
+async def read_owner(
+    owner: str, session: AsyncSession = Depends(get_async_read_session)
+):
+    # get the latest release of every repo
+    latest = (
+        select(Release.id)
+        .join(GitHubRepo)
         .join(GitHubOwner)
         .where(GitHubOwner.name == owner)
+        .distinct(Release.repo_id)
+        .order_by(Release.repo_id, Release.version_key.desc().nulls_last())
+        .subquery()
+    )
+    q = (
+        select(Release)
+        .join(GitHubRepo)
+        .where(col(Release.id).in_(select(latest.c.id)))
         .order_by(GitHubRepo.created_at.desc())
     )
-    repos = session.exec(q).all()
-
-    # get latest versions for repos
-    releases = []
-    for repo in repos:
-        sorted_releases = sort_releases(repo.releases)
-        if sorted_releases:
-            releases.append(sorted_releases[-1])
+    releases = (await session.exec(q)).all()
 
     releases_response = map(toFlakeReleaseCompact, releases)
     return {"repos": list(releases_response)}
@@ -132,27 +307,140 @@ def read_owner(owner: str, session: Session = Depends(get_session)):
         422: {"model": ValidationError},
     },
 )
-def read_repo(owner: str, repo: str, session: Session = Depends(get_session)):
+async def read_repo(
+    owner: str,
+    repo: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(default=100, ge=1, le=1000),
+    compact: bool = False,
+    session: AsyncSession = Depends(get_async_read_session),
+):
     statement = (
         select(GitHubRepo)
         .join(GitHubOwner)
         .where(GitHubOwner.name == owner)
         .where(GitHubRepo.name == repo)
     )
-    github_repo = session.exec(statement).first()
+    github_repo = (await session.exec(statement)).first()
 
     if not github_repo:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
-    # get all releases for repo
-    statement = select(Release).where(col(Release.repo_id) == github_repo.id)
-    releases = session.exec(statement).all()
-    releases = sort_releases(releases)
-    return {"releases": list(map(toFlakeRelease, releases))}
+    # get a page of releases for repo, newest version first
+    statement = (
+        select(Release)
+        .where(col(Release.repo_id) == github_repo.id)
+        .order_by(Release.version_key.desc().nulls_last(), Release.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor:
+        version_key, id = decode_cursor(cursor, 2, [is_version_key, is_id])
+        if version_key is None:
+            # Only releases without a key are left, in order of their id
+            after = and_(col(Release.version_key).is_(None), col(Release.id) < id)
+        else:
+            after = or_(
+                tuple_(Release.version_key, Release.id)
+                < tuple_(literal(version_key, ARRAY(BigInteger)), literal(id)),
+                col(Release.version_key).is_(None),
+            )
+        statement = statement.where(after)
+    if compact:
+        statement = statement.options(
+            load_only(
+                Release.id,
+                Release.version,
+                Release.version_key,
+                Release.commit,
+                Release.description,
+                Release.created_at,
+            )
+        )
+    else:
+        statement = statement.options(
+            undefer(Release.readme), undefer(Release.readme_html)
+        )
+    releases = (await session.exec(statement)).all()
+
+    next_cursor = None
+    if len(releases) > limit:
+        releases = releases[:limit]
+        next_cursor = encode_cursor(releases[-1].version_key, releases[-1].id)
+
+    return {
+        "releases": [toFlakeRelease(release, compact) for release in releases],
+        "next_cursor": next_cursor,
+    }
+
+
+def encode_cursor(*values: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(
+    cursor: str, length: int, checks: Sequence[Callable[[Any], bool]] = ()
+) -> list[Any]:
+    """Decode a cursor of `length` values, each passing its check if given.
+
+    Cursors come back from clients, anything that doesn't check out would
+    otherwise fail in the database."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor))
+    except (binascii.Error, ValueError):
+        values = None
+    if (
+        not isinstance(values, list)
+        or len(values) != length
+        or not all(check(value) for check, value in zip(checks, values))
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+    return values
+
+
+def is_integer(value: Any, bits: int = 64) -> bool:
+    """Whether a JSON value fits a signed integer column of `bits` bits."""
+    return (
+        isinstance(value, int)
+        and not isinstance(value, bool)
+        and -(2 ** (bits - 1)) <= value < 2 ** (bits - 1)
+    )
+
+
+def is_id(value: Any) -> bool:
+    return is_integer(value, 32)
+
+
+def is_str(value: Any) -> bool:
+    return isinstance(value, str)
+
+
+def is_optional_str(value: Any) -> bool:
+    return value is None or isinstance(value, str)
+
+
+def is_offset(value: Any) -> bool:
+    return is_integer(value) and value >= 0
+
+
+def is_search_after(value: Any) -> bool:
+    """The sort values of a hit, see search_sort."""
+    return value is None or (
+        isinstance(value, list)
+        and len(value) == len(search_sort)
+        and all(
+            part is None
+            or (isinstance(part, (int, float, str)) and not isinstance(part, bool))
+            for part in value
+        )
+    )
 
 
-def sort_releases(releases):
-    return sorted(releases, key=lambda r: parse(r.version), reverse=True)
+def is_version_key(value: Any) -> bool:
+    return value is None or (
+        isinstance(value, list) and all(is_integer(part) for part in value)
+    )
 
 
 def toFlakeReleaseCompact(release: Release) -> FlakeReleaseCompact:
@@ -165,7 +453,7 @@ def toFlakeReleaseCompact(release: Release) -> FlakeReleaseCompact:
     )
 
 
-def toFlakeRelease(release: Release) -> FlakeRelease:
+def toFlakeRelease(release: Release, compact: bool = False) -> FlakeRelease:
     return FlakeRelease(
         owner=release.repo.owner.name,
         repo=release.repo.name,
@@ -173,10 +461,18 @@ def toFlakeRelease(release: Release) -> FlakeRelease:
         version=release.version,
         commit=release.commit,
         created_at=release.created_at,
-        readme=release.readme or "",
+        readme=None if compact else release.readme or "",
+        readme_html=None if compact else release.readme_html,
     )
 
 
+@dataclass(frozen=True)
+class CachedBadge:
+    svg: str
+    etag: str
+    last_modified: datetime
+
+
 @router.get(
     "/badge/flake/github/{owner}/{repo}",
     responses={
@@ -185,16 +481,74 @@ def toFlakeRelease(release: Release) -> FlakeRelease:
     },
     response_class=Response,
 )
-def badge(owner: str, repo: str, session: Session = Depends(get_session)):
-    releases = read_repo(owner, repo, session)
-    latest = releases["releases"][0]
-    badge = anybadge.Badge(
-        label="flakestry.dev",
-        value=latest.version,
-        default_color="darkblue",
-        num_padding_chars=1,
-    )
-    return Response(content=badge.badge_svg_text, media_type="image/svg+xml")
+async def badge(
+    owner: str,
+    repo: str,
+    if_none_match: Optional[str] = Header(default=None),
+    if_modified_since: Optional[str] = Header(default=None),
+    session: AsyncSession = Depends(get_async_read_session),
+):
+    cached = badge_cache.get((owner, repo))
+    if not cached:
+        statement = (
+            select(Release.version, Release.created_at)
+            .join(GitHubRepo)
+            .join(GitHubOwner)
+            .where(GitHubOwner.name == owner)
+            .where(GitHubRepo.name == repo)
+            .order_by(Release.version_key.desc().nulls_last())
+            .limit(1)
+        )
+        latest = (await session.exec(statement)).first()
+
+        if not latest:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+        version, created_at = latest
+        badge = anybadge.Badge(
+            label="flakestry.dev",
+            value=version,
+            default_color="darkblue",
+            num_padding_chars=1,
+        )
+        digest = hashlib.sha1(f"{owner}/{repo}/{version}".encode()).hexdigest()
+        cached = CachedBadge(
+            svg=badge.badge_svg_text,
+            etag=f'"{digest}"',
+            last_modified=created_at.replace(tzinfo=timezone.utc, microsecond=0),
+        )
+        badge_cache.set((owner, repo), cached)
+
+    headers = {
+        "ETag": cached.etag,
+        "Last-Modified": format_datetime(cached.last_modified, usegmt=True),
+        # Let camo and CDNs revalidate once our own cache entry may be stale
+        "Cache-Control": f"public, max-age={int(badge_cache_ttl)}",
+    }
+    if not_modified(
+        cached.etag, cached.last_modified, if_none_match, if_modified_since
+    ):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=cached.svg, media_type="image/svg+xml", headers=headers)
+
+
+def not_modified(
+    etag: str,
+    last_modified: datetime,
+    if_none_match: Optional[str],
+    if_modified_since: Optional[str],
+) -> bool:
+    # If-None-Match takes precedence over If-Modified-Since, and compares
+    # ETags weakly
+    if if_none_match:
+        etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag.removeprefix("W/") in etags or "*" in etags
+    if if_modified_since:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
 
 
 @router.get(
@@ -204,15 +558,52 @@ def badge(owner: str, repo: str, session: Session = Depends(get_session)):
         422: {"model": ValidationError},
     },
 )
-def read_version(
-    owner: str, repo: str, version: str, session: Session = Depends(get_session)
+async def read_version(
+    owner: str,
+    repo: str,
+    version: str,
+    if_none_match: Optional[str] = Header(None),
+    session: AsyncSession = Depends(get_async_read_session),
 ):
     statement = (
         select(Release)
+        .options(undefer_group("content"))
         .join(GitHubRepo)
         .join(GitHubOwner)
         .where(GitHubOwner.name == owner)
         .where(GitHubRepo.name == repo)
         .where(Release.version == version)
     )
-    return session.exec(statement).first()
+    release = (await session.exec(statement)).first()
+
+    if not release:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    headers = {
+        "ETag": release_etag(release),
+        "Cache-Control": release_cache_control,
+    }
+    # The README is fetched after publish, until then the release can change
+    if release.readme_filename and release.readme_html is None:
+        headers["Cache-Control"] = "public, max-age=60"
+    if not_modified(headers["ETag"], release.created_at, if_none_match, None):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    # Trusted rows straight from the database: skip validating them against
+    # response_model and encode with orjson, outputs can run into megabytes
+    return ORJSONResponse(
+        {name: getattr(release, name) for name in Release.__fields__},
+        headers=headers,
+    )
+
+
+# A published version only changes when its README is rendered again, e.g.
+# by `python -m flakestry.readme backfill --force`. Stale copies are
+# revalidated with the ETag.
+release_cache_control = "public, max-age=3600"
+
+
+def release_etag(release: Release) -> str:
+    # Weak, the same ETag is sent for the brotli, gzip and identity bodies
+    rendered = release.readme_html is not None
+    key = f"{release.id}/{release.commit}/{rendered}/{release.updated_at}"
+    return f'W/"{hashlib.sha1(key.encode()).hexdigest()}"'
@@ -1,17 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from typing import Any
-from fastapi import APIRouter, Depends, Header, status
+import os
+from fastapi import APIRouter, Depends, Header, Response, status
 from fastapi_oidc import IDToken
 from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from opensearchpy import OpenSearch
+from pydantic import BaseModel, Field
 import re
-import requests
-from sqlmodel import Session, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import Session
+import httpx
 
+from flakestry.cache import badge_cache, search_cache
+from flakestry.suggest import suggester
 from flakestry.error import ValidationError
+from flakestry.github import get_github
+from flakestry.jobs import enqueue_many
 from flakestry.oidc import authenticate_user
-from flakestry.search import get_opensearch, opensearch_index
-from flakestry.sql import GitHubOwner, GitHubRepo, Release, get_session
+from flakestry.sql import (
+    GitHubOwner,
+    GitHubRepo,
+    Release,
+    get_session,
+    mark_written,
+    version_key,
+)
+
+publish_batch_size = int(os.environ.get("PUBLISH_BATCH_SIZE", 100))
+# Concurrent commit lookups per batch
+publish_batch_github_concurrency = int(
+    os.environ.get("PUBLISH_BATCH_GITHUB_CONCURRENCY", 8)
+)
+
+VERSION_REGEX = r"^v?([0-9]+\.[0-9]+\.?[0-9]*$)"
 
 
 class Publish(BaseModel):
@@ -24,57 +45,40 @@ class Publish(BaseModel):
     outputs_errors: str | None
 
 
-router = APIRouter()
+class PublishBatch(BaseModel):
+    releases: list[Publish] = Field(..., min_items=1, max_items=publish_batch_size)
 
 
-@router.post(
-    "/publish",
-    status_code=status.HTTP_201_CREATED,
-    response_model=None,
-    responses={
-        422: {"model": ValidationError},
-    },
-)
-def publish(
-    publish: Publish,
-    token: IDToken = Depends(authenticate_user),
-    github_token: str = Header(),
-    opensearch: OpenSearch = Depends(get_opensearch),
-    session: Session = Depends(get_session),
-):
-    # if id_token.repository_visibility == "private":
-    # return JSONResponse(status_code=400,
-    # content={"message": "Private repositories are not supported, \
-    # see https://github.com/flakestry/flakestry.dev/issues"})
+class PublishResult(BaseModel):
+    status: int
+    version: str | None
+    message: str | None
 
-    github_headers = {
-        "Authorization": f"Bearer {github_token}",
-        "X-GitHub-Api-Version": "2022-11-28",
-        "Accept": "application/vnd.github+json",
-    }
 
-    owner_name, repository_name = token.repository.split("/")
+class PublishBatchResult(BaseModel):
+    # In the order of the submitted releases
+    results: list[PublishResult]
+
+
+class PublishError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+def release_ref(publish: Publish) -> str:
     if publish.ref:
-        ref = publish.ref
+        return publish.ref
     elif publish.version:
-        ref = f"refs/tags/{publish.version}"
+        return f"refs/tags/{publish.version}"
     else:
-        return JSONResponse(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            content={"message": 'Neither "ref" nor "version" were provided'},
+        raise PublishError(
+            status.HTTP_400_BAD_REQUEST, 'Neither "ref" nor "version" were provided'
         )
 
-    # Get info on the commit to be published
-    commit_response = requests.get(
-        f"https://api.github.com/repos/{owner_name}/{repository_name}/commits/{ref}",
-        headers=github_headers,
-    )
-    commit_response.raise_for_status()
-    commit_json = commit_response.json()
-    commit_sha = commit_json["sha"]
-    commit_date = commit_json["commit"]["committer"]["date"]
 
-    # Validate & parse version
+def release_version(publish: Publish, commit_date: str) -> str:
     datetime = re.sub(r"[^0-9]", "", commit_date)
     if publish.version:
         given_version = publish.version.format(
@@ -87,71 +91,24 @@ def publish(
     else:
         given_version = f"v0.1.{datetime}"
 
-    version_regex = r"^v?([0-9]+\.[0-9]+\.?[0-9]*$)"
-    version = re.search(version_regex, given_version)
+    version = re.search(VERSION_REGEX, given_version)
     if not version:
-        return JSONResponse(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            content={"message": f"{given_version} doesn't match regex {version_regex}"},
-        )
-    else:
-        version = version.groups()[0]
-
-    # Create owner if it doesn't exist
-    owner = session.exec(
-        select(GitHubOwner).where(GitHubOwner.name == owner_name)
-    ).first()
-    if not owner:
-        owner = GitHubOwner(name=owner_name)
-        session.add(owner)
-        session.commit()
-        session.refresh(owner)
-
-    # Create repository if it doesn't exist
-    repo = session.exec(
-        select(GitHubRepo)
-        .where(GitHubRepo.name == repository_name)
-        .where(GitHubRepo.owner_id == owner.id)
-    ).first()
-    if not repo:
-        repo = GitHubRepo(name=repository_name, owner_id=owner.id)
-        session.add(repo)
-        session.commit()
-        session.refresh(repo)
-
-    # 409 if version already exists
-    if session.exec(
-        select(Release)
-        .where(Release.version == version)
-        .where(Release.repo_id == repo.id)
-    ).first():
-        return JSONResponse(
-            status_code=status.HTTP_409_CONFLICT,
-            content={"message": f"Version {version} already exists"},
+        raise PublishError(
+            status.HTTP_400_BAD_REQUEST,
+            f"{given_version} doesn't match regex {VERSION_REGEX}",
         )
+    return version.groups()[0]
 
-    # index README
+
+def release_values(publish: Publish, version: str, commit_sha: str) -> dict[str, Any]:
     try:
         description = publish.metadata["description"]
     except Exception:
         description = None
 
-    path = f"{owner_name}/{repository_name}/{commit_sha}/{publish.readme}"
-    if publish.readme:
-        readme_response = requests.get(
-            f"https://raw.githubusercontent.com/{path}", headers=github_headers
-        )
-        readme_response.raise_for_status()
-        readme = readme_response.text
-    else:
-        readme = None
-
-    # Do release
-    release = Release(
-        repo_id=repo.id,
+    return dict(
         version=version,
         readme_filename=publish.readme,
-        readme=readme,
         commit=commit_sha,
         description=description,
         meta_data=publish.metadata,
@@ -159,18 +116,219 @@ def publish(
         outputs=publish.outputs,
         outputs_errors=publish.outputs_errors,
     )
-    session.add(release)
+
+
+def upsert_repo(session: Session, owner_name: str, repository_name: str) -> int:
+    """Create the owner and repository unless they exist, returning the
+    repository id."""
+    # DO UPDATE rather than DO NOTHING, so RETURNING also yields existing rows
+    owner_id = session.execute(
+        insert(GitHubOwner)
+        .values(name=owner_name)
+        .on_conflict_do_update(
+            index_elements=[GitHubOwner.name], set_={"name": owner_name}
+        )
+        .returning(GitHubOwner.id)
+    ).scalar_one()
+    return session.execute(
+        insert(GitHubRepo)
+        .values(name=repository_name, owner_id=owner_id)
+        .on_conflict_do_update(
+            constraint="unique_owner_name", set_={"name": repository_name}
+        )
+        .returning(GitHubRepo.id)
+    ).scalar_one()
+
+
+def create_releases(
+    session: Session, repo_id: int, releases: list[dict[str, Any]]
+) -> dict[str, int]:
+    """Insert releases with the given `release_values` and enqueue their
+    jobs, skipping versions that already exist. Returns the id of each
+    created release by version."""
+    created: dict[str, int] = dict(
+        session.execute(
+            insert(Release)
+            .values(
+                [
+                    # Core inserts skip the ORM's before_insert listener
+                    dict(
+                        values,
+                        repo_id=repo_id,
+                        version_key=version_key(values["version"]),
+                    )
+                    for values in releases
+                ]
+            )
+            .on_conflict_do_nothing(constraint="unique_repo_version")
+            .returning(Release.version, Release.id)
+        ).all()
+    )
+
+    # Every release is searchable right away, fetch_readme reindexes it with
+    # its README. index_release jobs run in batches, each indexed with a
+    # single bulk request.
+    with_readme = [
+        created[values["version"]]
+        for values in releases
+        if values["version"] in created and values["readme_filename"]
+    ]
+    enqueue_many(session, "fetch_readme", with_readme)
+    enqueue_many(session, "index_release", list(created.values()))
+    return created
+
+
+def published(owner_name: str, repository_name: str):
+    badge_cache.delete((owner_name, repository_name))
+    search_cache.invalidate()
+    suggester.mark_stale()
+
+
+router = APIRouter()
+
+
+@router.post(
+    "/publish",
+    status_code=status.HTTP_201_CREATED,
+    response_model=None,
+    responses={
+        422: {"model": ValidationError},
+    },
+)
+def publish(
+    publish: Publish,
+    response: Response,
+    token: IDToken = Depends(authenticate_user),
+    github_token: str = Header(),
+    session: Session = Depends(get_session),
+):
+    # if id_token.repository_visibility == "private":
+    # return JSONResponse(status_code=400,
+    # content={"message": "Private repositories are not supported, \
+    # see https://github.com/flakestry/flakestry.dev/issues"})
+
+    owner_name, repository_name = token.repository.split("/")
+    try:
+        ref = release_ref(publish)
+
+        # Get info on the commit to be published
+        commit_json = get_github().commit(
+            owner_name, repository_name, ref, github_token
+        )
+        commit_sha = commit_json["sha"]
+        commit_date = commit_json["commit"]["committer"]["date"]
+
+        # Validate & parse version
+        version = release_version(publish, commit_date)
+    except PublishError as err:
+        return JSONResponse(
+            status_code=err.status_code, content={"message": err.message}
+        )
+
+    # One transaction: the owner and repository are upserted, and
+    # unique_repo_version turns a concurrent or repeated publish into a 409
+    repo_id = upsert_repo(session, owner_name, repository_name)
+    values = release_values(publish, version, commit_sha)
+    if not create_releases(session, repo_id, [values]):
+        session.rollback()
+        return JSONResponse(
+            status_code=status.HTTP_409_CONFLICT,
+            content={"message": f"Version {version} already exists"},
+        )
+
     session.commit()
-    session.refresh(release)
-
-    # Index release
-    document = {
-        "description": description,
-        "readme": readme,
-        "outputs": str(publish.outputs),
-        "repo": repository_name,
-        "owner": owner_name,
-    }
-    opensearch.index(index=opensearch_index, body=document, id=release.id, refresh=True)
+    published(owner_name, repository_name)
+    mark_written(response)
 
     return {}
+
+
+@router.post(
+    "/publish/batch",
+    response_model=PublishBatchResult,
+    responses={
+        422: {"model": ValidationError},
+    },
+)
+def publish_batch(
+    batch: PublishBatch,
+    response: Response,
+    token: IDToken = Depends(authenticate_user),
+    github_token: str = Header(),
+    session: Session = Depends(get_session),
+):
+    """Publish many releases of the token's repository, e.g. to backfill tags.
+
+    Each release is validated and created on its own, a result is reported
+    for each. The created releases are inserted in one transaction.
+    """
+    owner_name, repository_name = token.repository.split("/")
+    github = get_github()
+
+    def resolve(publish: Publish) -> dict[str, Any]:
+        commit_json = github.commit(
+            owner_name, repository_name, release_ref(publish), github_token
+        )
+        version = release_version(publish, commit_json["commit"]["committer"]["date"])
+        return release_values(publish, version, commit_json["sha"])
+
+    # Commit lookups are the slow part, each request copies the context for
+    # the request's timings
+    with ThreadPoolExecutor(publish_batch_github_concurrency) as executor:
+        futures = [
+            executor.submit(copy_context().run, resolve, publish)
+            for publish in batch.releases
+        ]
+
+    results: list[PublishResult] = []
+    pending: dict[str, tuple[PublishResult, dict[str, Any]]] = {}
+    for future in futures:
+        try:
+            values = future.result()
+        except PublishError as err:
+            results.append(PublishResult(status=err.status_code, message=err.message))
+            continue
+        except httpx.HTTPStatusError as err:
+            results.append(
+                PublishResult(
+                    status=status.HTTP_400_BAD_REQUEST,
+                    message=f"Commit lookup failed with {err.response.status_code}",
+                )
+            )
+            continue
+        except httpx.HTTPError as err:
+            results.append(
+                PublishResult(
+                    status=status.HTTP_502_BAD_GATEWAY,
+                    message=f"Commit lookup failed: {err}",
+                )
+            )
+            continue
+
+        version = values["version"]
+        result = PublishResult(status=status.HTTP_409_CONFLICT, version=version)
+        results.append(result)
+        if version in pending:
+            result.message = f"Version {version} is in the batch more than once"
+        else:
+            pending[version] = (result, values)
+
+    if not pending:
+        return PublishBatchResult(results=results)
+
+    repo_id = upsert_repo(session, owner_name, repository_name)
+    created = create_releases(
+        session, repo_id, [values for _, values in pending.values()]
+    )
+    for version, (result, _) in pending.items():
+        if version in created:
+            result.status = status.HTTP_201_CREATED
+        else:
+            result.message = f"Version {version} already exists"
+
+    session.commit()
+    if created:
+        published(owner_name, repository_name)
+        mark_written(response)
+
+    return PublishBatchResult(results=results)
@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional
+import os
+import threading
+import time
+
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
+
+meter = metrics.get_meter("flakestry.cache")
+
+
+class TTLCache:
+    """A bounded LRU cache whose entries expire `ttl` seconds after being set.
+
+    Safe to share between the event loop and threadpool workers.
+    A `ttl` of 0 disables caching.
+
+    `invalidate()` bumps a generation counter that is part of every key, so
+    all earlier entries stop matching at once and age out of the LRU.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        caches.append(self)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get((self.generation, key))
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[(self.generation, key)]
+                self.misses += 1
+                return None
+            self._data.move_to_end((self.generation, key))
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            key = (self.generation, key)
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._data.pop((self.generation, key), None)
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    @property
+    def size(self) -> int:
+        return len(self._data)
+
+
+caches: list[TTLCache] = []
+
+
+def observe(attribute: str):
+    def callback(options: CallbackOptions) -> Iterable[Observation]:
+        for cache in caches:
+            yield Observation(getattr(cache, attribute), {"cache": cache.name})
+
+    return callback
+
+
+meter.create_observable_counter(
+    "flakestry.cache.hits", callbacks=[observe("hits")], description="Cache hits"
+)
+meter.create_observable_counter(
+    "flakestry.cache.misses", callbacks=[observe("misses")], description="Cache misses"
+)
+meter.create_observable_gauge(
+    "flakestry.cache.size", callbacks=[observe("size")], description="Cache entries"
+)
+
+# Rendered badges keyed on (owner, repo), invalidated by publish.
+# The TTL bounds how stale other workers can be after a publish.
+badge_cache_ttl = float(os.environ.get("BADGE_CACHE_TTL", 300))
+badge_cache = TTLCache(
+    "badge",
+    maxsize=int(os.environ.get("BADGE_CACHE_SIZE", 10000)),
+    ttl=badge_cache_ttl,
+)
+
+# /flake responses keyed on the normalized query and page, invalidated by
+# publish and by indexing.
+search_cache = TTLCache(
+    "search",
+    maxsize=int(os.environ.get("SEARCH_CACHE_SIZE", 1000)),
+    ttl=float(os.environ.get("SEARCH_CACHE_TTL", 60)),
+)
@@ -0,0 +1,25 @@
+from typing import Any
+from fastapi.concurrency import run_in_threadpool
+
+
+class ThreadpoolProxy:
+    """Expose a blocking client through awaitable methods.
+
+    Every method call is run on Starlette's threadpool, so async route handlers
+    can share a single code path between the blocking clients (pg8000, the sync
+    OpenSearch client) and their native async counterparts.
+    """
+
+    def __init__(self, target: Any):
+        self._target = target
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            # Namespaced APIs, e.g. `opensearch.indices.create`
+            return ThreadpoolProxy(attr)
+
+        async def call(*args, **kwargs):
+            return await run_in_threadpool(attr, *args, **kwargs)
+
+        return call
@@ -0,0 +1,129 @@
+"""A shared client for the GitHub API and raw.githubusercontent.com.
+
+Connections are pooled and kept alive across publishes, over HTTP/2 where
+the server supports it. Every request has a timeout, and transient failures
+(connection errors, 429 and 5xx responses) are retried with exponential
+backoff.
+
+API responses with an ETag are cached, and later lookups of the same URL
+are made conditional with If-None-Match. GitHub answers those with 304 Not
+Modified, which doesn't count against the rate limit. Raw files are
+fetched by commit, once per release, so they aren't cached.
+
+Redirects are followed, GitHub redirects renamed and transferred repos.
+
+GITHUB_API_URL and GITHUB_RAW_URL point the client somewhere else, e.g. a
+fake GitHub server in development.
+"""
+
+from functools import lru_cache
+from typing import Any, Optional
+import logging
+import os
+import time
+
+import httpx
+
+from flakestry.cache import TTLCache
+from flakestry.telemetry import timed
+
+logger = logging.getLogger("uvicorn")
+
+github_api_url = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+github_raw_url = os.environ.get("GITHUB_RAW_URL", "https://raw.githubusercontent.com")
+github_timeout = float(os.environ.get("GITHUB_TIMEOUT", 10))
+github_retries = int(os.environ.get("GITHUB_RETRIES", 3))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class GitHub:
+    def __init__(
+        self,
+        api_url: str,
+        raw_url: str,
+        timeout: float,
+        retries: int,
+        backoff: float = 0.5,
+        etag_cache_size: int = 10000,
+        transport: Optional[httpx.BaseTransport] = None,
+    ):
+        self.api_url = api_url.rstrip("/")
+        self.raw_url = raw_url.rstrip("/")
+        self.retries = retries
+        self.backoff = backoff
+        self.client = httpx.Client(
+            http2=True,
+            follow_redirects=True,
+            timeout=httpx.Timeout(timeout, connect=min(timeout, 5)),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            headers={"User-Agent": "flakestry.dev"},
+            # A fake GitHub in tests
+            transport=transport,
+        )
+        # Keyed on the URL alone: a cached body is only used when GitHub
+        # answers 304 to the token of the request at hand
+        self.etags = TTLCache("github", maxsize=etag_cache_size, ttl=86400)
+
+    def get(self, url: str, headers: Optional[dict[str, str]] = None) -> httpx.Response:
+        """GET `url`, conditionally if it is an API URL fetched before."""
+        headers = dict(headers or {})
+        cacheable = url.startswith(f"{self.api_url}/")
+        cached: Optional[httpx.Response] = self.etags.get(url) if cacheable else None
+        if cached is not None:
+            headers["If-None-Match"] = cached.headers["ETag"]
+
+        response = self._get_with_retries(url, headers)
+        if response.status_code == httpx.codes.NOT_MODIFIED and cached is not None:
+            return cached
+        response.raise_for_status()
+        if cacheable and "ETag" in response.headers:
+            self.etags.set(url, response)
+        return response
+
+    def _get_with_retries(self, url: str, headers: dict[str, str]) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                with timed("github", "GET", **{"http.url": url}):
+                    response = self.client.get(url, headers=headers)
+                if (
+                    response.status_code not in RETRY_STATUS_CODES
+                    or attempt == self.retries
+                ):
+                    return response
+                delay = retry_after(response) or self.backoff * 2**attempt
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2**attempt
+            logger.warning(f"Retrying GitHub request {url} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def commit(self, owner: str, repo: str, ref: str, token: str) -> dict[str, Any]:
+        response = self.get(
+            f"{self.api_url}/repos/{owner}/{repo}/commits/{ref}",
+            headers={
+                "Authorization": f"Bearer {token}",
+                "X-GitHub-Api-Version": "2022-11-28",
+                "Accept": "application/vnd.github+json",
+            },
+        )
+        return response.json()
+
+    def raw(self, owner: str, repo: str, commit: str, path: str) -> str:
+        return self.get(f"{self.raw_url}/{owner}/{repo}/{commit}/{path}").text
+
+
+def retry_after(response: httpx.Response) -> Optional[float]:
+    try:
+        # Capped, rate limit resets can be an hour away
+        return min(float(response.headers["Retry-After"]), 30)
+    except (KeyError, ValueError):
+        return None
+
+
+@lru_cache
+def get_github() -> GitHub:
+    return GitHub(github_api_url, github_raw_url, github_timeout, github_retries)
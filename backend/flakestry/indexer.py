@@ -0,0 +1,167 @@
+"""Bulk indexing of releases into OpenSearch.
+
+Documents are written through the `_bulk` API and become searchable with
+the index's `refresh_interval`; nothing forces a refresh per document.
+
+    python -m flakestry.indexer reindex-all
+
+rebuilds the index from Postgres into a new versioned index and atomically
+points the `flakes` alias at it, so searches keep working throughout.
+"""
+
+from datetime import datetime, timedelta
+from typing import Any, Iterable, Optional
+import argparse
+import logging
+
+from opensearchpy import OpenSearch, helpers
+from sqlalchemy import func, or_
+from sqlalchemy.orm import undefer_group
+from sqlmodel import Session, select, col
+
+from flakestry.search import (
+    create_index,
+    get_opensearch,
+    opensearch_index,
+    opensearch_refresh_interval,
+)
+from flakestry.sql import Release, engine
+
+logger = logging.getLogger("uvicorn")
+
+
+reindex_clock_skew = timedelta(minutes=1)
+
+# Keys of output leaves rather than attribute names
+OUTPUT_LEAF_KEYS = {"type", "name", "description"}
+
+
+def output_names(outputs: Optional[dict[str, Any]]) -> list[str]:
+    """All attribute names in a flake's outputs, e.g.
+    {"packages": {"x86_64-linux": {"git": {...}}}}
+    -> ["packages", "x86_64-linux", "git"]"""
+    names: dict[str, None] = {}
+    stack = [outputs or {}]
+    while stack:
+        for name, value in stack.pop().items():
+            if name in OUTPUT_LEAF_KEYS or not isinstance(value, dict):
+                continue
+            names[name] = None
+            stack.append(value)
+    return list(names)
+
+
+def release_document(release: Release) -> dict[str, Any]:
+    # Search results are built from these documents, see api.flake.get_flakes
+    return {
+        "version": release.version,
+        "created_at": release.created_at.isoformat(),
+        "description": release.description,
+        "readme": release.readme,
+        "outputs": output_names(release.outputs),
+        "repo": release.repo.name,
+        "owner": release.repo.owner.name,
+    }
+
+
+def index_releases(
+    opensearch: OpenSearch,
+    releases: Iterable[Release],
+    index: str = opensearch_index,
+    chunk_size: int = 500,
+) -> int:
+    """Index releases with `_bulk` requests of `chunk_size` documents."""
+    actions = (
+        {"_index": index, "_id": release.id, "_source": release_document(release)}
+        for release in releases
+    )
+    indexed, _ = helpers.bulk(opensearch, actions, chunk_size=chunk_size)
+    return indexed
+
+
+def stream_releases(
+    session: Session, chunk_size: int, *conditions: Any
+) -> Iterable[Release]:
+    """Yield all releases matching `conditions` ordered by id, loading
+    `chunk_size` rows at a time."""
+    after_id = 0
+    while True:
+        releases = session.exec(
+            select(Release)
+            .options(undefer_group("content"))
+            .where(col(Release.id) > after_id, *conditions)
+            .order_by(Release.id)
+            .limit(chunk_size)
+        ).all()
+        if not releases:
+            return
+        yield from releases
+        after_id = releases[-1].id
+        session.expunge_all()
+
+
+def swap_alias(opensearch: OpenSearch, index: str) -> list[str]:
+    """Point the alias at `index` in one atomic request.
+
+    Returns the indices that were behind the alias before."""
+    actions: list[dict[str, Any]] = [
+        {"add": {"index": index, "alias": opensearch_index}}
+    ]
+    previous: list[str] = []
+    if opensearch.indices.exists_alias(name=opensearch_index):
+        previous = list(opensearch.indices.get_alias(name=opensearch_index))
+        actions += [
+            {"remove": {"index": name, "alias": opensearch_index}} for name in previous
+        ]
+    elif opensearch.indices.exists(index=opensearch_index):
+        # A concrete index from before the alias existed
+        actions.append({"remove_index": {"index": opensearch_index}})
+    opensearch.indices.update_aliases(body={"actions": actions})
+    return previous
+
+
+def reindex_all(chunk_size: int = 500, keep_previous: bool = False) -> str:
+    # Releases changed from here on may have been indexed into the previous
+    # index only, e.g. by fetch_readme. Allow for clock skew between the
+    # machines that set updated_at.
+    started = datetime.utcnow() - reindex_clock_skew
+    opensearch = get_opensearch()
+    # Refreshing is pointless until the alias points at the new index
+    index = create_index(opensearch, refresh_interval="-1")
+    logger.info(f"Indexing all releases into {index}")
+
+    with Session(engine) as session:
+        last_id = session.exec(select(func.max(Release.id))).one() or 0
+        index_releases(opensearch, stream_releases(session, chunk_size), index)
+
+    opensearch.indices.put_settings(
+        index=index, body={"index": {"refresh_interval": opensearch_refresh_interval}}
+    )
+    opensearch.indices.refresh(index=index)
+    previous = swap_alias(opensearch, index)
+
+    # Catch up with releases published or changed while reindexing
+    with Session(engine) as session:
+        changed = or_(col(Release.id) > last_id, col(Release.updated_at) >= started)
+        index_releases(opensearch, stream_releases(session, chunk_size, changed))
+
+    if not keep_previous:
+        for name in previous:
+            opensearch.indices.delete(index=name)
+    logger.info(f"{opensearch_index} now points to {index}")
+    return index
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Manage the flakes search index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    reindex = commands.add_parser(
+        "reindex-all", help="Rebuild the index from Postgres without downtime"
+    )
+    reindex.add_argument("--chunk-size", type=int, default=500)
+    reindex.add_argument("--keep-previous", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "reindex-all":
+        reindex_all(args.chunk_size, args.keep_previous)
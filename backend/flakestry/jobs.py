@@ -0,0 +1,239 @@
+"""Background jobs for published releases.
+
+Jobs are rows in the `job` table, inserted in the same transaction as the
+release they belong to. Workers claim due jobs with `SKIP LOCKED`, so any
+number of them can run side by side: inside the app (see main.py) or
+standalone with `python -m flakestry.jobs`. A claim leases the jobs by moving
+their `run_at` ahead by `JOB_LEASE` seconds and commits right away, so no
+locks or connections are held while handlers talk to GitHub or OpenSearch.
+A job whose worker dies is due again once its lease runs out.
+
+Enqueueing a job that is already pending makes it due right away. If a
+worker is running it at that moment, the job is kept when the worker
+finishes and runs once more, e.g. to index a README fetched after the
+worker loaded the release.
+
+A job is unique per (name, release id) while pending, and every handler can
+safely run more than once. Failed jobs are retried with exponential backoff,
+capped at `JOB_MAX_RETRY_DELAY`, so they outlast an outage of OpenSearch or
+GitHub of a few hours. Once they run out of attempts they are kept with
+`failed` set, which is logged as an error. Enqueueing the job again starts
+over.
+
+Releases are indexed as soon as they are published. A README that can't be
+fetched leaves the release searchable, just without its README.
+
+Handlers receive a list of releases: a single one, unless the handler was
+registered with `batch=True` and gets all claimed releases at once.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Callable
+import asyncio
+import logging
+import os
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import undefer_group
+from sqlmodel import Session, select, col
+
+from flakestry.cache import search_cache
+from flakestry.github import get_github
+from flakestry.indexer import index_releases
+from flakestry.readme import render_release_readme
+from flakestry.search import get_opensearch
+from flakestry.sql import Job, Release, engine
+
+logger = logging.getLogger("uvicorn")
+
+job_poll_interval = float(os.environ.get("JOB_POLL_INTERVAL", 1))
+job_max_attempts = int(os.environ.get("JOB_MAX_ATTEMPTS", 12))
+# Seconds before the first retry, doubling up to the maximum
+job_retry_delay = float(os.environ.get("JOB_RETRY_DELAY", 10))
+job_max_retry_delay = float(os.environ.get("JOB_MAX_RETRY_DELAY", 3600))
+job_batch_size = int(os.environ.get("JOB_BATCH_SIZE", 100))
+# Seconds until a claimed job is due again, unless its worker finishes it
+job_lease = float(os.environ.get("JOB_LEASE", 300))
+
+Handler = Callable[[Session, list[Release]], None]
+
+# name -> (handler, batch)
+handlers: dict[str, tuple[Handler, bool]] = {}
+
+
+def job(batch: bool = False):
+    def register(handler: Handler) -> Handler:
+        handlers[handler.__name__] = (handler, batch)
+        return handler
+
+    return register
+
+
+def enqueue(session: Session, name: str, release_id: int):
+    enqueue_many(session, name, [release_id])
+
+
+def enqueue_many(session: Session, name: str, release_ids: list[int]):
+    assert name in handlers, f"Unknown job {name}"
+    if not release_ids:
+        return
+    run_at = datetime.utcnow()
+    statement = insert(Job).values(
+        [
+            dict(
+                name=name,
+                release_id=release_id,
+                attempts=0,
+                failed=False,
+                run_at=run_at,
+            )
+            # An upsert can't touch the same row twice
+            for release_id in dict.fromkeys(release_ids)
+        ]
+    )
+    session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[Job.name, Job.release_id],
+            index_where=text("NOT failed"),
+            # Ends the lease of a claimed job, see complete()
+            set_={"run_at": statement.excluded.run_at},
+        )
+    )
+
+
+@job()
+def fetch_readme(session: Session, releases: list[Release]):
+    for release in releases:
+        release.readme = get_github().raw(
+            release.repo.owner.name,
+            release.repo.name,
+            release.commit,
+            release.readme_filename,
+        )
+        render_release_readme(release)
+        session.add(release)
+        # Indexed on publish already, without the README. Committed along
+        # with the README, which also reruns an index_release job that is
+        # running right now.
+        enqueue(session, "index_release", release.id)
+
+
+@job(batch=True)
+def index_release(session: Session, releases: list[Release]):
+    index_releases(get_opensearch(), releases)
+    search_cache.invalidate()
+
+
+def retry_delay(attempts: int) -> float:
+    return min(job_retry_delay * 2 ** (attempts - 1), job_max_retry_delay)
+
+
+def claim() -> list[Job]:
+    """Lease a batch of due jobs to this worker."""
+    with Session(engine, expire_on_commit=False) as session:
+        jobs = session.exec(
+            select(Job)
+            .where(col(Job.failed).is_(False))
+            .where(Job.run_at <= datetime.utcnow())
+            .order_by(Job.run_at)
+            .limit(job_batch_size)
+            .with_for_update(skip_locked=True)
+        ).all()
+        leased_until = datetime.utcnow() + timedelta(seconds=job_lease)
+        for job in jobs:
+            job.run_at = leased_until
+            session.add(job)
+        session.commit()
+        return list(jobs)
+
+
+def run_pending() -> int:
+    """Run a batch of due jobs and return how many were claimed."""
+    jobs = claim()
+
+    by_name: dict[str, list[Job]] = defaultdict(list)
+    for job in jobs:
+        by_name[job.name].append(job)
+
+    for name, named_jobs in by_name.items():
+        handler, batch = handlers[name]
+        for group in [named_jobs] if batch else [[job] for job in named_jobs]:
+            run_group(handler, group)
+
+    return len(jobs)
+
+
+def run_group(handler: Handler, jobs: list[Job]):
+    try:
+        with Session(engine, expire_on_commit=False) as session:
+            releases = session.exec(
+                select(Release)
+                .options(undefer_group("content"))
+                .where(col(Release.id).in_([job.release_id for job in jobs]))
+            ).all()
+            # Don't stay in a transaction while the handler does its I/O
+            session.commit()
+            handler(session, list(releases))
+            session.commit()
+    except Exception as e:
+        logger.exception(f"Job {jobs[0].name} failed for {len(jobs)} release(s)")
+        fail(jobs, e)
+    else:
+        complete(jobs)
+
+
+def complete(jobs: list[Job]):
+    """Delete finished jobs, unless they were enqueued again meanwhile."""
+    with Session(engine) as session:
+        session.execute(
+            delete(Job).where(
+                tuple_(Job.id, Job.run_at).in_([(job.id, job.run_at) for job in jobs])
+            )
+        )
+        session.commit()
+
+
+def fail(jobs: list[Job], error: Exception):
+    """Schedule a retry of failed jobs, or give up on them."""
+    with Session(engine) as session:
+        for job in jobs:
+            attempts = job.attempts + 1
+            values: dict[str, Any] = dict(attempts=attempts, last_error=repr(error))
+            if attempts >= job_max_attempts:
+                values["failed"] = True
+            else:
+                values["run_at"] = datetime.utcnow() + timedelta(
+                    seconds=retry_delay(attempts)
+                )
+            # Jobs enqueued again meanwhile are due already
+            updated = session.execute(
+                update(Job)
+                .where(col(Job.id) == job.id)
+                .where(col(Job.run_at) == job.run_at)
+                .values(**values)
+            ).rowcount
+            if updated and values.get("failed"):
+                logger.error(
+                    f"Giving up on job {job.name} for release {job.release_id} "
+                    f"after {attempts} attempts: {values['last_error']}"
+                )
+        session.commit()
+
+
+async def worker():
+    while True:
+        try:
+            claimed = await run_in_threadpool(run_pending)
+        except Exception:
+            logger.exception("Job worker failed")
+            claimed = 0
+        if not claimed:
+            await asyncio.sleep(job_poll_interval)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(worker())
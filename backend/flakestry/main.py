@@ -3,17 +3,23 @@ from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+from brotli_asgi import BrotliMiddleware
 import sentry_sdk
+import asyncio
 import os
 
-from flakestry.sql import create_db_and_tables
+import flakestry.jobs
+import flakestry.oidc
+import flakestry.search
+from flakestry.telemetry import ServerTimingMiddleware, traces_sampler
 import flakestry.api.publish
 import flakestry.api.flake
 
 if os.environ.get("SENTRY_DSN", None):
     sentry_sdk.init(
         dsn=os.environ["SENTRY_DSN"],
-        traces_sample_rate=1.0,
+        # SENTRY_TRACES_SAMPLE_RATE, capped per route by SENTRY_TRACES_PER_MINUTE
+        traces_sampler=traces_sampler,
     )
 
 app = FastAPI(
@@ -32,10 +38,31 @@ app = FastAPI(
 # openapi-generator does not currently support 3.1.0.
 app.openapi_version = "3.0.0"
 
+# Rendered READMEs and release outputs compress well.
+# Brotli where the client accepts it, gzip otherwise.
+app.add_middleware(BrotliMiddleware, minimum_size=1000, gzip_fallback=True)
+app.add_middleware(ServerTimingMiddleware)
+
+# Startup does no DDL, the schema is migrated once per deploy by
+# `python -m flakestry.migrations`
+
+
+@app.on_event("startup")
+async def start_jwks_refresh():
+    app.state.jwks_refresh = asyncio.create_task(flakestry.oidc.jwks.run())
+
 
 @app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
+async def start_search_bootstrap():
+    app.state.search_bootstrap = asyncio.create_task(flakestry.search.bootstrap())
+
+
+# Process publish jobs in-process, unless they run as a separate worker
+if os.environ.get("FLAKESTRY_JOB_WORKER", "true").lower() == "true":
+
+    @app.on_event("startup")
+    async def start_job_worker():
+        app.state.job_worker = asyncio.create_task(flakestry.jobs.worker())
 
 
 # TODO: make the routes more visible from a glance
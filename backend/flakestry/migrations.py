@@ -0,0 +1,291 @@
+"""Versioned schema migrations, run once per deploy:
+
+    python -m flakestry.migrations
+
+The app itself does no DDL on startup.
+
+`SQLModel.metadata.create_all` creates missing tables, but never changes
+existing ones. Every change to an existing table is added to `MIGRATIONS`
+with the next version number. Migrations run in order, exactly once, and
+must also be a no-op on a database freshly created by `create_all`.
+"""
+
+from typing import Callable
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.engine import Connection, Engine
+from sqlmodel import SQLModel
+
+from flakestry.sql import engine, version_key
+
+logger = logging.getLogger("uvicorn")
+
+# Arbitrary key to serialize migrations between workers
+MIGRATION_LOCK = 0x666C616B65
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def add_release_version_key(connection: Connection):
+    connection.execute(
+        text("ALTER TABLE release ADD COLUMN IF NOT EXISTS version_key bigint[]")
+    )
+    rows = connection.execute(
+        text("SELECT id, version FROM release WHERE version_key IS NULL")
+    ).all()
+    for start in range(0, len(rows), BACKFILL_CHUNK_SIZE):
+        connection.execute(
+            text("UPDATE release SET version_key = :key WHERE id = :id"),
+            [
+                {"id": id, "key": version_key(version)}
+                for id, version in rows[start : start + BACKFILL_CHUNK_SIZE]
+            ],
+        )
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_release_repo_id_version_key "
+            "ON release (repo_id, version_key)"
+        )
+    )
+
+
+def add_lookup_indexes(connection: Connection):
+    # (githubrepo.owner_id, name) and (release.repo_id, version) are already
+    # covered by the indexes behind unique_owner_name and unique_repo_version
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_githubowner_name ON githubowner (name)")
+    )
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_release_created_at_id "
+            "ON release (created_at, id)"
+        )
+    )
+
+
+def compress_release_content(connection: Connection):
+    # lz4 compresses and decompresses several times faster than the default
+    # pglz. Postgres compresses TOASTed values as they are written, so this
+    # covers every publish from now on. Needs Postgres 14 built with lz4.
+    if connection.dialect.server_version_info < (14,):
+        logger.warning("Postgres < 14, keeping pglz for release content")
+        return
+    try:
+        with connection.begin_nested():
+            for column in ("readme", "meta_data", "outputs"):
+                connection.execute(
+                    text(
+                        f"ALTER TABLE release ALTER COLUMN {column} SET COMPRESSION lz4"
+                    )
+                )
+    except DBAPIError:
+        logger.warning("Postgres lacks lz4, keeping pglz for release content")
+
+
+def add_release_readme_html(connection: Connection):
+    # Rendered by `python -m flakestry.readme backfill`
+    connection.execute(
+        text("ALTER TABLE release ADD COLUMN IF NOT EXISTS readme_html varchar")
+    )
+
+
+def unique_owner_name(connection: Connection):
+    # Publishes upsert owners with ON CONFLICT (name). Owners duplicated by
+    # racing publishes are merged into the oldest one first. Those races
+    # usually duplicated the repo as well, so same-named repos of an owner
+    # are merged into the oldest one, keeping the first release of each
+    # version.
+    connection.execute(
+        text(
+            "CREATE TEMPORARY TABLE repo_merge ON COMMIT DROP AS "
+            "SELECT id, keep_id FROM ("
+            "SELECT githubrepo.id, min(githubrepo.id) OVER ("
+            "PARTITION BY githubowner.name, githubrepo.name) AS keep_id "
+            "FROM githubrepo JOIN githubowner ON githubowner.id = owner_id"
+            ") AS repos WHERE id <> keep_id"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TEMPORARY TABLE release_merge ON COMMIT DROP AS "
+            "SELECT id FROM ("
+            "SELECT release.id, min(release.id) OVER ("
+            "PARTITION BY coalesce(repo_merge.keep_id, release.repo_id), version"
+            ") AS keep_id "
+            "FROM release LEFT JOIN repo_merge ON repo_merge.id = release.repo_id "
+            "WHERE release.repo_id IN ("
+            "SELECT id FROM repo_merge UNION SELECT keep_id FROM repo_merge)"
+            ") AS releases WHERE id <> keep_id"
+        )
+    )
+    connection.execute(
+        text("DELETE FROM job WHERE release_id IN (SELECT id FROM release_merge)")
+    )
+    deleted = connection.execute(
+        text("DELETE FROM release WHERE id IN (SELECT id FROM release_merge)")
+    ).rowcount
+    if deleted:
+        logger.warning(
+            f"Deleted {deleted} duplicate releases, run "
+            "`python -m flakestry.indexer reindex-all` to drop them from search"
+        )
+    connection.execute(
+        text(
+            "UPDATE release SET repo_id = repo_merge.keep_id FROM repo_merge "
+            "WHERE release.repo_id = repo_merge.id"
+        )
+    )
+    connection.execute(
+        text("DELETE FROM githubrepo WHERE id IN (SELECT id FROM repo_merge)")
+    )
+
+    connection.execute(
+        text(
+            "UPDATE githubrepo SET owner_id = keep.id "
+            "FROM githubowner AS dup, ("
+            "SELECT min(id) AS id, name FROM githubowner GROUP BY name"
+            ") AS keep "
+            "WHERE githubrepo.owner_id = dup.id "
+            "AND dup.name = keep.name AND dup.id <> keep.id"
+        )
+    )
+    connection.execute(
+        text(
+            "DELETE FROM githubowner AS dup USING githubowner AS keep "
+            "WHERE dup.name = keep.name AND dup.id > keep.id"
+        )
+    )
+    connection.execute(text("DROP INDEX IF EXISTS ix_githubowner_name"))
+    connection.execute(
+        text("CREATE UNIQUE INDEX ix_githubowner_name ON githubowner (name)")
+    )
+
+
+def widen_release_version_key(connection: Connection):
+    # Datetime versions, e.g. v0.1.20231026123456, overflow integer
+    connection.execute(
+        text("ALTER TABLE release ALTER COLUMN version_key TYPE bigint[]")
+    )
+
+
+def compute_release_version_key(connection: Connection):
+    # Machines still running the previous release keep inserting without a
+    # version_key while a deploy rolls out, and NULLs sort first on DESC.
+    # Like flakestry.sql.version_key, but skipping anything non-numeric
+    # rather than failing the insert.
+    connection.execute(
+        text(
+            "CREATE OR REPLACE FUNCTION release_version_key(version varchar) "
+            "RETURNS bigint[] LANGUAGE plpgsql IMMUTABLE AS $$ "
+            "DECLARE key bigint[] := ARRAY("
+            "SELECT part::bigint "
+            "FROM unnest(string_to_array(version, '.')) WITH ORDINALITY AS p(part, n) "
+            "WHERE part ~ '^[0-9]+$' ORDER BY n); "
+            "BEGIN "
+            "WHILE cardinality(key) > 0 AND key[cardinality(key)] = 0 LOOP "
+            "key := key[1:cardinality(key) - 1]; "
+            "END LOOP; "
+            "RETURN key; "
+            "END $$"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE OR REPLACE FUNCTION set_release_version_key() "
+            "RETURNS trigger LANGUAGE plpgsql AS $$ "
+            "BEGIN "
+            "NEW.version_key := coalesce("
+            "NEW.version_key, release_version_key(NEW.version)); "
+            "RETURN NEW; "
+            "END $$"
+        )
+    )
+    connection.execute(text("DROP TRIGGER IF EXISTS release_version_key ON release"))
+    connection.execute(
+        text(
+            "CREATE TRIGGER release_version_key BEFORE INSERT ON release "
+            "FOR EACH ROW EXECUTE FUNCTION set_release_version_key()"
+        )
+    )
+    connection.execute(
+        text(
+            "UPDATE release SET version_key = release_version_key(version) "
+            "WHERE version_key IS NULL"
+        )
+    )
+    connection.execute(
+        text("ALTER TABLE release ALTER COLUMN version_key SET NOT NULL")
+    )
+    # Newest version first, with the id as tiebreaker, see api.flake.read_repo
+    connection.execute(text("DROP INDEX IF EXISTS ix_release_repo_id_version_key"))
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_release_repo_id_version_key_desc "
+            "ON release (repo_id, version_key DESC NULLS LAST, id DESC)"
+        )
+    )
+
+
+def partial_unique_job(connection: Connection):
+    # Failed jobs kept a release from ever being enqueued again
+    connection.execute(text("ALTER TABLE job DROP CONSTRAINT IF EXISTS unique_job"))
+    connection.execute(
+        text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS unique_pending_job "
+            "ON job (name, release_id) WHERE NOT failed"
+        )
+    )
+
+
+def add_release_updated_at(connection: Connection):
+    # Left NULL for existing releases, see indexer.reindex_all
+    connection.execute(
+        text("ALTER TABLE release ADD COLUMN IF NOT EXISTS updated_at timestamp")
+    )
+
+
+MIGRATIONS: list[tuple[int, Callable[[Connection], None]]] = [
+    (1, add_release_version_key),
+    (2, add_lookup_indexes),
+    (3, compress_release_content),
+    (4, add_release_readme_html),
+    (5, unique_owner_name),
+    (6, widen_release_version_key),
+    (7, compute_release_version_key),
+    (8, partial_unique_job),
+    (9, add_release_updated_at),
+]
+
+
+def migrate(engine: Engine):
+    with engine.begin() as connection:
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK}
+        )
+        SQLModel.metadata.create_all(connection)
+        connection.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS schema_migration ("
+                "version integer PRIMARY KEY, "
+                "applied_at timestamp NOT NULL DEFAULT now())"
+            )
+        )
+        applied = set(
+            connection.execute(text("SELECT version FROM schema_migration")).scalars()
+        )
+        for version, migration in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Applying migration {version}: {migration.__name__}")
+            migration(connection)
+            connection.execute(
+                text("INSERT INTO schema_migration (version) VALUES (:version)"),
+                {"version": version},
+            )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate(engine)
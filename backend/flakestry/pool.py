@@ -0,0 +1,107 @@
+"""Connection pool settings and metrics for the SQL engines.
+
+DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE and
+DB_POOL_PRE_PING map onto the SQLAlchemy pool arguments of the same name.
+
+With DB_PGBOUNCER=true connections go through PgBouncer in transaction mode:
+PgBouncer does the pooling, so the engines open a connection per checkout
+(NullPool) and asyncpg's prepared statement caches are disabled, since a
+statement prepared on one server connection is not there on the next.
+"""
+
+from typing import Any, Iterable
+import os
+import time
+
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+meter = metrics.get_meter("flakestry.pool")
+
+pgbouncer = os.environ.get("DB_PGBOUNCER", "false").lower() == "true"
+pool_size = int(os.environ.get("DB_POOL_SIZE", 5))
+max_overflow = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+# Fly's proxy drops idle connections, recycle them before it does
+pool_recycle = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+pool_pre_ping = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+
+checkout_wait = meter.create_histogram(
+    "flakestry.db.pool.wait",
+    unit="s",
+    description="Time spent waiting for a pooled connection",
+)
+
+engines: dict[str, Engine] = {}
+
+
+class TimedCheckout:
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()  # type: ignore[misc]
+        finally:
+            checkout_wait.record(
+                time.perf_counter() - started, {"pool": self._orig_logging_name}
+            )
+
+
+class SyncPool(TimedCheckout, QueuePool):
+    pass
+
+
+class AsyncPool(TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(name: str, asyncio: bool = False) -> dict[str, Any]:
+    if pgbouncer:
+        options: dict[str, Any] = {"poolclass": NullPool}
+        if asyncio:
+            options["connect_args"] = {
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+            }
+        return options
+    return {
+        "poolclass": AsyncPool if asyncio else SyncPool,
+        "pool_logging_name": name,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pool_pre_ping,
+    }
+
+
+def register(name: str, engine: Engine):
+    engines[name] = engine
+
+
+def observe(measure):
+    def callback(options: CallbackOptions) -> Iterable[Observation]:
+        for name, engine in engines.items():
+            # Looked up each time, the pool is replaced on `engine.dispose()`
+            if isinstance(engine.pool, QueuePool):
+                yield Observation(measure(engine.pool), {"pool": name})
+
+    return callback
+
+
+meter.create_observable_gauge(
+    "flakestry.db.pool.checked_out",
+    callbacks=[observe(lambda pool: pool.checkedout())],
+    description="Connections currently checked out",
+)
+meter.create_observable_gauge(
+    "flakestry.db.pool.idle",
+    callbacks=[observe(lambda pool: pool.checkedin())],
+    description="Idle connections in the pool",
+)
+meter.create_observable_gauge(
+    "flakestry.db.pool.overflow",
+    callbacks=[observe(lambda pool: pool.overflow())],
+    description="Connections opened beyond the pool size",
+)
@@ -0,0 +1,112 @@
+"""Render READMEs to sanitized HTML once per release, instead of on every
+page view.
+
+Releases published before `readme_html` existed are rendered with:
+
+    python -m flakestry.readme backfill
+"""
+
+from typing import Optional
+from urllib.parse import urljoin
+import argparse
+import logging
+
+from markdown_it import MarkdownIt
+from sqlalchemy.orm import load_only, undefer
+from sqlmodel import Session, col, select
+import nh3
+
+from flakestry.sql import Release, engine
+
+logger = logging.getLogger("uvicorn")
+
+# Raw HTML is allowed in the markdown, nh3 strips anything unsafe afterwards
+markdown = MarkdownIt("commonmark", {"html": True}).enable(["table", "strikethrough"])
+
+ALLOWED_ATTRIBUTES = {
+    **nh3.ALLOWED_ATTRIBUTES,
+    # Code blocks are highlighted by language in the browser
+    "code": {"class"},
+    "div": {"align"},
+    "p": {"align"},
+    **{f"h{level}": {"align"} for level in range(1, 7)},
+}
+
+
+def readme_urls(release: Release) -> tuple[str, str]:
+    """Base URLs for relative links and for relative images in the README."""
+    repo = f"https://github.com/{release.repo.owner.name}/{release.repo.name}"
+    revision = release.commit or "HEAD"
+    return f"{repo}/blob/{revision}/", f"{repo}/raw/{revision}/"
+
+
+def render_readme(readme: str, base_url: str, raw_base_url: str) -> str:
+    def rewrite(element: str, attribute: str, value: str) -> Optional[str]:
+        if attribute == "class":
+            return value if value.startswith("language-") else None
+        if attribute == "href" and not value.startswith("#"):
+            return urljoin(base_url, value.lstrip("/"))
+        if attribute == "src":
+            return urljoin(raw_base_url, value.lstrip("/"))
+        return value
+
+    return nh3.clean(
+        markdown.render(readme),
+        attributes=ALLOWED_ATTRIBUTES,
+        attribute_filter=rewrite,
+    )
+
+
+def render_release_readme(release: Release):
+    if release.readme is None:
+        release.readme_html = None
+    else:
+        release.readme_html = render_readme(release.readme, *readme_urls(release))
+
+
+def backfill(chunk_size: int, force: bool) -> int:
+    """Render the README of releases that have none rendered, or of all
+    releases with `force`. Returns the number of releases rendered."""
+    rendered = 0
+    after_id = 0
+    with Session(engine) as session:
+        while True:
+            statement = (
+                select(Release)
+                .options(
+                    load_only(Release.id, Release.commit),
+                    undefer(Release.readme),
+                )
+                .where(col(Release.id) > after_id)
+                .where(col(Release.readme).is_not(None))
+                .order_by(Release.id)
+                .limit(chunk_size)
+            )
+            if not force:
+                statement = statement.where(col(Release.readme_html).is_(None))
+            releases = session.exec(statement).all()
+            if not releases:
+                return rendered
+            for release in releases:
+                render_release_readme(release)
+            session.commit()
+            rendered += len(releases)
+            after_id = releases[-1].id
+            logger.info(f"Rendered {rendered} READMEs")
+            session.expunge_all()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser(
+        "backfill", help="render READMEs of existing releases"
+    )
+    backfill_parser.add_argument("--chunk-size", type=int, default=500)
+    backfill_parser.add_argument(
+        "--force", action="store_true", help="re-render every README"
+    )
+    args = parser.parse_args()
+    if args.command == "backfill":
+        backfill(args.chunk_size, args.force)
@@ -1,17 +1,217 @@
+from datetime import datetime
 from functools import lru_cache
+from typing import Any, Optional
+import asyncio
+import logging
 import os
-from opensearchpy import OpenSearch
+from fastapi.concurrency import run_in_threadpool
+from opensearchpy import AsyncOpenSearch, OpenSearch, RequestError
 
+from flakestry.concurrency import ThreadpoolProxy
+from flakestry.telemetry import AsyncTimedConnection, TimedConnection
+
+# An alias to the current versioned index, see flakestry.indexer
 opensearch_index = "flakes"
+opensearch_host = os.environ.get("OPENSEARCH_HOST", "localhost")
+# New documents become searchable within this interval
+opensearch_refresh_interval = os.environ.get("OPENSEARCH_REFRESH_INTERVAL", "1s")
+
+logger = logging.getLogger("uvicorn")
+
+# Bump the version whenever the settings or mappings change.
+# Existing indices are migrated with `python -m flakestry.indexer reindex-all`.
+opensearch_mapping_version = 2
+
+opensearch_analysis = {
+    "filter": {
+        "prefix": {"type": "edge_ngram", "min_gram": 1, "max_gram": 20},
+    },
+    "analyzer": {
+        "prefix": {
+            "type": "custom",
+            "tokenizer": "standard",
+            "filter": ["lowercase", "prefix"],
+        },
+    },
+}
+
+# owner/repo as typed, e.g. for exact matches and aggregations, and as
+# prefixes for search-as-you-type
+name_field = {
+    "type": "text",
+    "fields": {
+        "keyword": {"type": "keyword"},
+        "prefix": {
+            "type": "text",
+            "analyzer": "prefix",
+            "search_analyzer": "standard",
+        },
+    },
+}
+
+opensearch_mappings = {
+    "dynamic": False,
+    "_meta": {"version": opensearch_mapping_version},
+    "properties": {
+        "owner": name_field,
+        "repo": name_field,
+        "version": {"type": "keyword"},
+        "description": {"type": "text"},
+        "created_at": {"type": "date"},
+        # Only ever matched on terms, so skip positions
+        "readme": {"type": "text", "index_options": "freqs"},
+        # Attribute names of the flake outputs, see indexer.output_names
+        "outputs": {"type": "text", "index_options": "freqs"},
+    },
+}
+
+# Use the aiohttp based client for the read API
+async_io = os.environ.get("FLAKESTRY_ASYNC_IO", "false").lower() == "true"
 
 
 @lru_cache()
-def get_opensearch():
-    host = os.environ.get("OPENSEARCH_HOST", "localhost")
-    opensearch = OpenSearch(
-        hosts=[{"host": host, "port": 9200}],
+def get_opensearch_client() -> OpenSearch:
+    """The shared client. Creating it doesn't contact OpenSearch."""
+    return OpenSearch(
+        hosts=[{"host": opensearch_host, "port": 9200}],
+        connection_class=TimedConnection,
     )
 
-    if not opensearch.indices.exists(index=opensearch_index):
-        opensearch.indices.create(opensearch_index, body={})
+
+@lru_cache()
+def get_opensearch() -> OpenSearch:
+    """The shared client, once the index behind the alias exists.
+
+    Blocks on OpenSearch and raises while it is unreachable, so this must not
+    be called on the event loop."""
+    opensearch = get_opensearch_client()
+    ensure_index(opensearch)
     return opensearch
+
+
+def ensure_index(opensearch: OpenSearch):
+    if not opensearch.indices.exists(index=opensearch_index):
+        # Workers race to create the first index. With a fixed name only one
+        # of them succeeds, rather than several indices ending up behind the
+        # alias, which breaks writes to it.
+        try:
+            create_index(
+                opensearch,
+                aliases={opensearch_index: {}},
+                name=f"{opensearch_index}-initial",
+            )
+        except RequestError as err:
+            if err.error != "resource_already_exists_exception":
+                raise
+    else:
+        for name, mapping in opensearch.indices.get_mapping(
+            index=opensearch_index
+        ).items():
+            version = mapping["mappings"].get("_meta", {}).get("version", 0)
+            if version < opensearch_mapping_version:
+                logger.warning(
+                    f"Index {name} has mapping version {version}, "
+                    f"expected {opensearch_mapping_version}. "
+                    "Run `python -m flakestry.indexer reindex-all`."
+                )
+
+
+async def bootstrap():
+    """Create the index in the background, retrying with backoff until
+    OpenSearch is reachable."""
+    failures = 0
+    while True:
+        try:
+            await run_in_threadpool(get_opensearch)
+            return
+        except Exception:
+            failures += 1
+            logger.exception("Failed to set up the search index")
+            await asyncio.sleep(min(2**failures, 60))
+
+
+def create_index(
+    opensearch: OpenSearch,
+    refresh_interval: Optional[str] = None,
+    aliases: Optional[dict] = None,
+    name: Optional[str] = None,
+) -> str:
+    """Create a new versioned index and return its name."""
+    name = name or f"{opensearch_index}-{datetime.utcnow():%Y%m%d%H%M%S%f}"
+    settings = {
+        "refresh_interval": refresh_interval or opensearch_refresh_interval,
+        "analysis": opensearch_analysis,
+    }
+    opensearch.indices.create(
+        name,
+        body={
+            "settings": {"index": settings},
+            "mappings": opensearch_mappings,
+            "aliases": aliases or {},
+        },
+    )
+    return name
+
+
+# Totals are counted exactly up to this many hits
+search_total_hits_threshold = 1000
+# Pages up to this depth use from/size, deeper ones search_after in a
+# point in time
+search_shallow_limit = 1000
+search_pit_keep_alive = "1m"
+# owner/repo/version is unique, which search_after needs as a tiebreaker.
+# Indices from before the explicit mapping have no version field, sorting
+# on an unmapped field is an error without unmapped_type.
+search_sort = [
+    {"_score": "desc"},
+    *(
+        {field: {"order": "asc", "unmapped_type": "keyword"}}
+        for field in ("owner.keyword", "repo.keyword", "version")
+    ),
+]
+
+
+def search_query(q: str) -> dict[str, Any]:
+    return {
+        "bool": {
+            "should": [
+                {
+                    "multi_match": {
+                        "query": q,
+                        "fuzziness": "AUTO",
+                        "fields": [
+                            "description^2",
+                            "readme",
+                            "outputs",
+                            "repo^2",
+                            "owner^2",
+                        ],
+                    }
+                },
+                # Rank names starting with the query, e.g. "home" for home-manager
+                {
+                    "multi_match": {
+                        "query": q,
+                        "fields": ["repo.prefix^2", "owner.prefix"],
+                    }
+                },
+            ]
+        }
+    }
+
+
+@lru_cache()
+def _get_async_opensearch_client():
+    return AsyncOpenSearch(
+        hosts=[{"host": opensearch_host, "port": 9200}],
+        connection_class=AsyncTimedConnection,
+    )
+
+
+# Requests must be awaited: `await opensearch.search(...)`.
+# The index is created on startup, see main.py, never on the request path.
+async def get_async_opensearch():
+    if async_io:
+        return _get_async_opensearch_client()
+    else:
+        return ThreadpoolProxy(get_opensearch_client())
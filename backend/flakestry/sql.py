@@ -1,5 +1,9 @@
 from typing import Optional, List, Any
+from contextlib import asynccontextmanager
+import math
 import os
+import random
+import time
 from datetime import datetime
 import logging
 from sqlmodel import (
@@ -10,15 +14,24 @@ from sqlmodel import (
     UniqueConstraint,
     create_engine,
 )
-from sqlalchemy import Column
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import BigInteger, Column, Index, event, text
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import deferred
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from fastapi import Request, Response
+from fastapi.concurrency import run_in_threadpool
+
+from flakestry.concurrency import ThreadpoolProxy
+from flakestry.pool import engine_options, register
 
 logger = logging.getLogger("uvicorn")
 
 
 class GitHubOwner(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    name: str
+    name: str = Field(index=True, unique=True)
     created_at: datetime = Field(
         default_factory=datetime.utcnow,
     )
@@ -44,6 +57,15 @@ class GitHubRepo(SQLModel, table=True):
 class Release(SQLModel, table=True):
     __table_args__ = (
         UniqueConstraint("repo_id", "version", name="unique_repo_version"),
+        # Newest version first, see api.flake.read_repo
+        Index(
+            "ix_release_repo_id_version_key_desc",
+            "repo_id",
+            text("version_key DESC NULLS LAST"),
+            text("id DESC"),
+        ),
+        # Latest releases, scanned backwards
+        Index("ix_release_created_at_id", "created_at", "id"),
     )
 
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -54,12 +76,25 @@ class Release(SQLModel, table=True):
 
     readme_filename: Optional[str]
     readme: Optional[str]
+    # Sanitized HTML rendering of readme, see flakestry.readme
+    readme_html: Optional[str]
     version: str
+    # Sortable form of version, see version_key(). Filled in by a trigger
+    # for inserts that leave it out, see migrations.compute_release_version_key
+    version_key: Optional[List[int]] = Field(
+        default=None, sa_column=Column(ARRAY(BigInteger), nullable=False)
+    )
     commit: str
     description: str | None
     created_at: datetime = Field(
         default_factory=datetime.utcnow,
     )
+    # Set on every ORM update, e.g. once the README is fetched or rendered.
+    # NULL for releases from before the column existed.
+    updated_at: Optional[datetime] = Field(
+        default_factory=datetime.utcnow,
+        sa_column_kwargs={"onupdate": datetime.utcnow},
+    )
     meta_data: Optional[dict[str, Any]] = Field(
         default_factory=dict, sa_column=Column(JSONB)
     )
@@ -70,18 +105,128 @@ class Release(SQLModel, table=True):
     outputs_errors: Optional[str]
 
 
+# The content columns can run into megabytes, listings never need them.
+# Load them with `.options(undefer_group("content"))`, they are not lazy
+# loaded on the async path.
+for name in ("readme", "readme_html", "meta_data", "outputs"):
+    Release.__mapper__.add_property(
+        name, deferred(Release.__table__.c[name], group="content")
+    )
+
+
+class Job(SQLModel, table=True):
+    """Background work for a release, see flakestry.jobs."""
+
+    # Failed jobs are kept for inspection, they don't block new ones
+    __table_args__ = (
+        Index(
+            "unique_pending_job",
+            "name",
+            "release_id",
+            unique=True,
+            postgresql_where=text("NOT failed"),
+        ),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str
+    release_id: int = Field(foreign_key="release.id")
+    attempts: int = 0
+    run_at: datetime = Field(default_factory=datetime.utcnow)
+    failed: bool = False
+    last_error: Optional[str]
+    created_at: datetime = Field(
+        default_factory=datetime.utcnow,
+    )
+
+
+def version_key(version: str) -> list[int]:
+    """Turn a version into a list of integers that Postgres orders like
+    packaging.version does, e.g. "23.05" -> [23, 5] and "1.2.0" -> [1, 2].
+    The release_version_key() SQL function computes the same.
+
+    Components can exceed 32 bits, e.g. the datetime in v0.1.20231026123456,
+    and the publish regex lets through a trailing dot, e.g. "1.2."."""
+    key = [int(part) for part in version.split(".") if part]
+    while key and key[-1] == 0:
+        key.pop()
+    return key
+
+
+@event.listens_for(Release, "before_insert")
+def set_version_key(mapper, connection, release: Release):
+    if release.version_key is None:
+        release.version_key = version_key(release.version)
+
+
+def engine_urls(database_url: str) -> tuple[str, str]:
+    scheme, rest = database_url.split("://")
+    # needed for pg8000 and asyncpg
+    rest = rest.replace("?sslmode=disable", "")
+    return f"postgresql+pg8000://{rest}", f"postgresql+asyncpg://{rest}"
+
+
 host = os.environ.get("PGHOST", None)
 
 if host:
     engine_url = f"postgresql+pg8000://{os.environ['USER']}@flakestry?unix_sock={host}/.s.PGSQL.5432"
+    # "flakestry" is the host part of the pg8000 URL, so both connect to the
+    # database named after the user
+    async_engine_url = f"postgresql+asyncpg://{os.environ['USER']}@/?host={host}"
 else:
-    scheme, rest = os.environ["DATABASE_URL"].split("://")
-    engine_url = f"postgresql+pg8000://{rest}"
-    # needed for pg8000
-    engine_url = engine_url.replace("?sslmode=disable", "")
+    engine_url, async_engine_url = engine_urls(os.environ["DATABASE_URL"])
+
+# Serve the read API through asyncpg instead of pg8000 on the threadpool
+async_io = os.environ.get("FLAKESTRY_ASYNC_IO", "false").lower() == "true"
+
+
+def create_engines(name: str, url: str, async_url: str):
+    # https://community.fly.io/t/postgresql-connection-issues-have-returned/6424/6
+    sync_engine = create_engine(url, **engine_options(name))
+    register(name, sync_engine)
+    if not async_io:
+        return sync_engine, None
+    async_engine = create_async_engine(
+        async_url, **engine_options(f"{name}-async", asyncio=True)
+    )
+    register(f"{name}-async", async_engine.sync_engine)
+    return sync_engine, async_engine
+
+
+engine, async_engine = create_engines("primary", engine_url, async_engine_url)
+
+# Comma separated read replicas, serving the read API
+replicas = [
+    create_engines(f"replica-{i}", *engine_urls(url.strip()))
+    for i, url in enumerate(os.environ.get("DATABASE_REPLICA_URLS", "").split(","))
+    if url.strip()
+]
 
-# https://community.fly.io/t/postgresql-connection-issues-have-returned/6424/6
-engine = create_engine(engine_url, pool_pre_ping=True)
+# A client's reads stay on the primary for this long after it publishes, so
+# it sees its release before the replicas have caught up. The time of the
+# publish is kept in a cookie rather than in memory, any machine or worker
+# may serve the next read.
+replica_lag_window = float(os.environ.get("REPLICA_LAG_WINDOW", 10))
+written_cookie = "flakestry_written"
+
+
+def mark_written(response: Response):
+    response.set_cookie(
+        written_cookie,
+        str(time.time()),
+        max_age=math.ceil(replica_lag_window),
+        httponly=True,
+        samesite="lax",
+    )
+
+
+def recently_written(request: Request) -> bool:
+    try:
+        written_at = float(request.cookies.get(written_cookie, ""))
+    except ValueError:
+        return False
+    # Allow for clock skew between machines, but not a cookie from the future
+    return abs(time.time() - written_at) < replica_lag_window
 
 
 def create_db_and_tables():
@@ -91,3 +236,31 @@ def create_db_and_tables():
 def get_session():
     with Session(engine) as session:
         yield session
+
+
+@asynccontextmanager
+async def open_async_session(sync_engine: Engine, async_engine: Optional[AsyncEngine]):
+    if async_engine is not None:
+        async with AsyncSession(async_engine) as session:
+            yield session
+    else:
+        session = Session(sync_engine)
+        try:
+            yield ThreadpoolProxy(session)
+        finally:
+            # Returning the connection to the pool rolls it back, a blocking
+            # round trip that must not run on the event loop
+            await run_in_threadpool(session.close)
+
+
+# Queries must be awaited: `await session.exec(statement)`.
+# Relationships are not lazy loaded on the async path, so load them in the query.
+# Served by a replica when there are any, read-only routes must not write
+# through it.
+async def get_async_read_session(request: Request):
+    if replicas and not recently_written(request):
+        engines = random.choice(replicas)
+    else:
+        engines = (engine, async_engine)
+    async with open_async_session(*engines) as session:
+        yield session
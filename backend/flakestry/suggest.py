@@ -0,0 +1,101 @@
+"""In-memory prefix index of owner/repo names for search-as-you-type.
+
+Names are kept in a sorted list of lowercased keys and looked up with bisect,
+so a suggestion costs a binary search plus a short scan and never touches
+Postgres. The index is rebuilt in the background every
+SUGGEST_REFRESH_INTERVAL seconds, or on the next lookup after a publish.
+"""
+
+from bisect import bisect_left
+from typing import Iterable, Optional
+import asyncio
+import logging
+import os
+import time
+
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import Session, select
+
+from flakestry.sql import GitHubOwner, GitHubRepo, engine
+
+logger = logging.getLogger("uvicorn")
+
+suggest_refresh_interval = float(os.environ.get("SUGGEST_REFRESH_INTERVAL", 60))
+
+
+class PrefixIndex:
+    """Match a prefix against `owner/repo` and against `repo` alone."""
+
+    def __init__(self, names: Iterable[tuple[str, str]]):
+        entries = []
+        for owner, repo in names:
+            entries.append((f"{owner}/{repo}".lower(), owner, repo))
+            entries.append((repo.lower(), owner, repo))
+        entries.sort()
+        self._keys = [key for key, _, _ in entries]
+        self._names = [(owner, repo) for _, owner, repo in entries]
+
+    def __len__(self) -> int:
+        return len(self._names) // 2
+
+    def search(self, prefix: str, limit: int) -> list[tuple[str, str]]:
+        prefix = prefix.lower()
+        found: dict[tuple[str, str], None] = {}
+        i = bisect_left(self._keys, prefix)
+        while (
+            len(found) < limit
+            and i < len(self._keys)
+            and self._keys[i].startswith(prefix)
+        ):
+            found.setdefault(self._names[i])
+            i += 1
+        return list(found)
+
+
+def load_names() -> list[tuple[str, str]]:
+    with Session(engine) as session:
+        return session.exec(
+            select(GitHubOwner.name, GitHubRepo.name).join(GitHubRepo)
+        ).all()
+
+
+class Suggester:
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.index: Optional[PrefixIndex] = None
+        self.stale = True
+        self._built_at = 0.0
+        self._refresh: Optional[asyncio.Task] = None
+
+    def mark_stale(self):
+        self.stale = True
+
+    async def rebuild(self):
+        self.stale = False
+        started = time.monotonic()
+        try:
+            self.index = PrefixIndex(await run_in_threadpool(load_names))
+        except Exception:
+            self.stale = True
+            if self.index is None:
+                raise
+            logger.exception("Failed to rebuild the suggestion index")
+            return
+        self._built_at = started
+        logger.info(
+            "Built suggestion index of %d repos in %.3fs",
+            len(self.index),
+            time.monotonic() - started,
+        )
+
+    async def get(self) -> PrefixIndex:
+        expired = time.monotonic() - self._built_at > self.refresh_interval
+        if (self.stale or expired) and (self._refresh is None or self._refresh.done()):
+            self._refresh = asyncio.create_task(self.rebuild())
+        # Only the first lookup waits, later ones are served the previous index
+        if self.index is None:
+            await asyncio.shield(self._refresh)
+        return self.index
+
+
+suggester = Suggester(suggest_refresh_interval)
@@ -0,0 +1,195 @@
+"""Where the time goes within a request.
+
+Database queries, OpenSearch requests and GitHub calls are each traced as
+OpenTelemetry spans, recorded in `flakestry.<kind>.duration` histograms, and
+summed per request into a `Server-Timing` response header, e.g.
+
+    Server-Timing: db;dur=4.1;desc="3 queries", search;dur=12.0, total;dur=18.3
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Optional
+import os
+import time
+
+from opensearchpy import AIOHttpConnection, Urllib3HttpConnection
+from opentelemetry import metrics, trace
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+tracer = trace.get_tracer("flakestry")
+meter = metrics.get_meter("flakestry")
+
+KINDS = ("db", "search", "github")
+UNITS = {
+    "db": ("query", "queries"),
+    "search": ("request", "requests"),
+    "github": ("request", "requests"),
+}
+
+durations = {
+    kind: meter.create_histogram(
+        f"flakestry.{kind}.duration", unit="ms", description=f"Duration of {kind} calls"
+    )
+    for kind in KINDS
+}
+calls_per_request = {
+    kind: meter.create_histogram(
+        f"flakestry.{kind}.calls_per_request", description=f"{kind} calls per request"
+    )
+    for kind in KINDS
+}
+
+
+class Timings:
+    def __init__(self):
+        self.count = dict.fromkeys(KINDS, 0)
+        self.duration = dict.fromkeys(KINDS, 0.0)
+
+    def add(self, kind: str, duration: float):
+        self.count[kind] += 1
+        self.duration[kind] += duration
+
+    def header(self, total: float) -> str:
+        metrics = []
+        for kind in KINDS:
+            if self.count[kind]:
+                one, many = UNITS[kind]
+                desc = f"{self.count[kind]} {one if self.count[kind] == 1 else many}"
+                metrics.append(f'{kind};dur={self.duration[kind]:.1f};desc="{desc}"')
+        metrics.append(f"total;dur={total:.1f}")
+        return ", ".join(metrics)
+
+
+# The timings of the current request. Threadpool calls run in a copy of the
+# context, which still refers to the same Timings.
+request_timings: ContextVar[Optional[Timings]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+def record(kind: str, duration: float):
+    """Record a call of `kind` that took `duration` milliseconds."""
+    durations[kind].record(duration)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add(kind, duration)
+
+
+@contextmanager
+def timed(kind: str, name: str, **attributes: Any):
+    with tracer.start_as_current_span(name, attributes=attributes):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            record(kind, (time.perf_counter() - started) * 1000)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    span = tracer.start_span(
+        statement.split(None, 1)[0] if statement else "query",
+        attributes={"db.system": "postgresql", "db.statement": statement},
+    )
+    conn.info.setdefault("query_start", []).append((time.perf_counter(), span))
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started, span = conn.info["query_start"].pop()
+    span.end()
+    record("db", (time.perf_counter() - started) * 1000)
+
+
+@event.listens_for(Engine, "handle_error")
+def handle_error(context):
+    if context.connection is not None and context.connection.info.get("query_start"):
+        started, span = context.connection.info["query_start"].pop()
+        span.record_exception(context.original_exception)
+        span.end()
+        record("db", (time.perf_counter() - started) * 1000)
+
+
+class TimedConnection(Urllib3HttpConnection):
+    def perform_request(self, method, url, *args, **kwargs):
+        with timed("search", f"opensearch {method}", **{"http.url": url}):
+            return super().perform_request(method, url, *args, **kwargs)
+
+
+class AsyncTimedConnection(AIOHttpConnection):
+    async def perform_request(self, method, url, *args, **kwargs):
+        with timed("search", f"opensearch {method}", **{"http.url": url}):
+            return await super().perform_request(method, url, *args, **kwargs)
+
+
+class ServerTimingMiddleware:
+    """Collect the timings of each request into a Server-Timing header."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = Timings()
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+
+        async def send_with_timings(message: Message):
+            if message["type"] == "http.response.start":
+                total = (time.perf_counter() - started) * 1000
+                header = timings.header(total).encode()
+                message.setdefault("headers", []).append((b"server-timing", header))
+                for kind in KINDS:
+                    calls_per_request[kind].record(timings.count[kind])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            request_timings.reset(token)
+
+
+class AdaptiveSampler:
+    """Sentry `traces_sampler` that samples at `rate`, but caps every route
+    at roughly `per_minute` traces, so busy routes like the badge cost no
+    more to trace than quiet ones.
+
+    Routes are told apart by the first segment of their path, which keeps
+    the number of counters bounded.
+    """
+
+    def __init__(self, rate: float, per_minute: float):
+        self.rate = rate
+        self.per_minute = per_minute
+        self.window = 0
+        self.current: dict[str, int] = {}
+        self.previous: dict[str, int] = {}
+
+    def __call__(self, sampling_context: dict[str, Any]) -> float:
+        parent_sampled = sampling_context.get("parent_sampled")
+        if parent_sampled is not None:
+            return float(parent_sampled)
+
+        window = int(time.monotonic() // 60)
+        if window != self.window:
+            self.previous = self.current if window == self.window + 1 else {}
+            self.current = {}
+            self.window = window
+
+        path = sampling_context.get("asgi_scope", {}).get("path", "")
+        route = path.strip("/").split("/", 1)[0]
+        self.current[route] = self.current.get(route, 0) + 1
+        # Last minute's traffic predicts this minute's
+        seen = max(self.previous.get(route, 0), self.current[route])
+        return min(self.rate, self.per_minute / seen)
+
+
+traces_sampler = AdaptiveSampler(
+    rate=float(os.environ.get("SENTRY_TRACES_SAMPLE_RATE", 1.0)),
+    per_minute=float(os.environ.get("SENTRY_TRACES_PER_MINUTE", 60)),
+)
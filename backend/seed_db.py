@@ -1,32 +1,210 @@
+"""Seed the database and search index for development.
+
+    python seed_db.py
+
+loads a handful of real flakes.
+
+    python seed_db.py synthetic --owners 20000
+
+generates a deterministic corpus at production scale, around 60000 repos
+and 300000 releases with the defaults, for benchmarks.
+
+Either way, the database and index are reset first. Releases are streamed
+in batches of --batch-size: rows are written with COPY and documents with
+`_bulk` requests, so memory use doesn't grow with the corpus.
+"""
+
 # ruff: noqa
+from datetime import datetime
+from typing import Any, Iterable, Optional
+import argparse
+import io
+import json
+import logging
 import os
+import random
+import time
+
+from opensearchpy import OpenSearch
+from sqlalchemy import text
+from sqlmodel import Session
+
+from benchmarks import synthetic
+from flakestry.indexer import index_releases, swap_alias
+from flakestry.migrations import migrate
+from flakestry.readme import render_release_readme
+from flakestry.search import (
+    create_index,
+    get_opensearch,
+    opensearch_index,
+    opensearch_refresh_interval,
+)
 from flakestry.sql import (
-    create_db_and_tables,
-    get_session,
     GitHubOwner,
     GitHubRepo,
     Release,
+    engine,
+    version_key,
 )
-from flakestry.search import get_opensearch, opensearch_index
+
+logger = logging.getLogger("uvicorn")
+
+OWNER_COLUMNS = ["id", "name", "created_at"]
+REPO_COLUMNS = ["id", "name", "description", "owner_id", "created_at"]
+RELEASE_COLUMNS = [
+    "id",
+    "repo_id",
+    "readme_filename",
+    "readme",
+    "readme_html",
+    "version",
+    "version_key",
+    "commit",
+    "description",
+    "created_at",
+    "meta_data",
+    "meta_data_errors",
+    "outputs",
+    "outputs_errors",
+]
+
+
+def copy_value(value: Any) -> str:
+    """`value` in COPY's text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    elif isinstance(value, dict):
+        value = json.dumps(value)
+    elif isinstance(value, list):
+        value = "{" + ",".join(map(str, value)) + "}"
+    else:
+        value = str(value)
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy(session: Session, table: str, columns: list[str], rows: list[Any]):
+    """COPY the `columns` attributes of `rows` into `table`."""
+    if not rows:
+        return
+    data = "".join(
+        "\t".join(copy_value(getattr(row, column)) for column in columns) + "\n"
+        for row in rows
+    )
+    cursor = session.connection().connection.cursor()
+    quoted = ", ".join(f'"{column}"' for column in columns)
+    cursor.execute(
+        f"COPY {table} ({quoted}) FROM STDIN", stream=io.BytesIO(data.encode())
+    )
+
+
+def allocate_ids(session: Session, table: str, rows: list[Any]):
+    """Assign ids from the table's sequence, COPY doesn't return them."""
+    ids = session.execute(
+        text(
+            "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+            "FROM generate_series(1, :count)"
+        ),
+        {"table": table, "count": len(rows)},
+    ).scalars()
+    for row, id in zip(rows, ids):
+        row.id = id
 
 
-# TODO: reuse /publish logic for this
-def main() -> None:
-    session = next(get_session())
+def write_batch(
+    session: Session,
+    repos: list[GitHubRepo],
+    owner_ids: dict[str, int],
+    opensearch: Optional[OpenSearch],
+    index: str,
+) -> int:
+    """Write repos with their owners and releases in one transaction, and
+    index the releases. Returns the number of releases written."""
+    owners = {
+        repo.owner.name: repo.owner
+        for repo in repos
+        if repo.owner.name not in owner_ids
+    }
+    allocate_ids(session, "githubowner", list(owners.values()))
+    owner_ids.update((name, owner.id) for name, owner in owners.items())
+    copy(session, "githubowner", OWNER_COLUMNS, list(owners.values()))
 
-    session.exec("DROP TABLE IF EXISTS release CASCADE")
-    session.exec("DROP TABLE IF EXISTS githubrepo CASCADE")
-    session.exec("DROP TABLE IF EXISTS githubowner CASCADE")
+    allocate_ids(session, "githubrepo", repos)
+    releases = []
+    for repo in repos:
+        repo.owner_id = owner_ids[repo.owner.name]
+        for release in repo.releases:
+            release.repo_id = repo.id
+            release.version_key = version_key(release.version)
+            if release.readme_html is None:
+                render_release_readme(release)
+            releases.append(release)
+    copy(session, "githubrepo", REPO_COLUMNS, repos)
+
+    allocate_ids(session, "release", releases)
+    copy(session, "release", RELEASE_COLUMNS, releases)
     session.commit()
 
-    create_db_and_tables()
+    if opensearch is not None:
+        index_releases(opensearch, releases, index)
+    return len(releases)
+
+
+def load(
+    repos: Iterable[GitHubRepo], batch_size: int, opensearch: Optional[OpenSearch]
+) -> int:
+    """Reset the database and index, then load `repos` in batches of about
+    `batch_size` releases. Returns the number of releases loaded."""
+    with Session(engine) as session:
+        for table in ("job", "release", "githubrepo", "githubowner"):
+            session.execute(text(f"DROP TABLE IF EXISTS {table} CASCADE"))
+        session.execute(text("DROP TABLE IF EXISTS schema_migration"))
+        session.commit()
+    migrate(engine)
+
+    index = opensearch_index
+    if opensearch is not None:
+        # Refreshing is pointless until the alias points at the new index
+        index = create_index(opensearch, refresh_interval="-1")
+
+    owner_ids: dict[str, int] = {}
+    batch: list[GitHubRepo] = []
+    batch_releases = 0
+    loaded = 0
+    started = time.perf_counter()
+    with Session(engine) as session:
+        for repo in repos:
+            batch.append(repo)
+            batch_releases += len(repo.releases)
+            if batch_releases >= batch_size:
+                loaded += write_batch(session, batch, owner_ids, opensearch, index)
+                batch, batch_releases = [], 0
+                rate = loaded / (time.perf_counter() - started)
+                logger.info(f"Loaded {loaded} releases, {rate:.0f}/s")
+        loaded += write_batch(session, batch, owner_ids, opensearch, index)
 
+    if opensearch is not None:
+        opensearch.indices.put_settings(
+            index=index,
+            body={"index": {"refresh_interval": opensearch_refresh_interval}},
+        )
+        opensearch.indices.refresh(index=index)
+        for name in swap_alias(opensearch, index):
+            opensearch.indices.delete(index=name)
+    logger.info(f"Loaded {loaded} releases from {len(owner_ids)} owners")
+    return loaded
+
+
+def fixtures() -> list[GitHubRepo]:
     nixos = GitHubOwner(name="nixos")
     nix_community = GitHubOwner(name="nix-community")
 
-    session.add(nixos)
-    session.add(nix_community)
-
     nixos_repo = GitHubRepo(
         name="nixpkgs",
         description="Nix Packages collection & NixOS",
@@ -48,11 +226,6 @@ def main() -> None:
         owner=nix_community,
     )
 
-    session.add(nixos_repo)
-    session.add(nix_repo)
-    session.add(home_manager_repo)
-    session.add(disko_repo)
-
     pwd = os.path.dirname(__file__)
     with open(os.path.join(pwd, "seed/nixpkgs-readme.md"), "r") as f:
         readme = f.read()
@@ -369,26 +542,40 @@ def main() -> None:
             outputs_errors="",
         )
 
-    session.add(nixpkgs_release)
-    session.add(home_manager_release)
-
-    session.commit()
-
-    opensearch = get_opensearch()
-    opensearch.indices.delete(index=opensearch_index, ignore=[400, 404])
-
-    for release in [nixpkgs_release, nixpkgs_release_22, home_manager_release]:
-        document = {
-            "description": release.repo.description,
-            "readme": release.readme,
-            "outputs": str(release.outputs),
-            "repo": release.repo.name,
-            "owner": release.repo.owner.name,
-        }
-        opensearch.index(
-            index=opensearch_index, body=document, id=release.id, refresh=True
-        )
+    return [nixos_repo, nix_repo, home_manager_repo, disko_repo]
 
 
 if __name__ == "__main__":
-    main()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--batch-size", type=int, default=1000, help="releases per transaction"
+    )
+    parser.add_argument(
+        "--no-search",
+        action="store_true",
+        help="skip OpenSearch, e.g. to run `python -m flakestry.indexer "
+        "reindex-all` later",
+    )
+    commands = parser.add_subparsers(dest="command")
+    generate = commands.add_parser("synthetic", help="generate a synthetic corpus")
+    generate.add_argument("--owners", type=int, default=20000)
+    generate.add_argument("--repos-per-owner", type=float, default=3)
+    generate.add_argument("--releases-per-repo", type=float, default=5)
+    generate.add_argument(
+        "--max-packages", type=int, default=2000, help="per system, per release"
+    )
+    generate.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "synthetic":
+        repos: Iterable[GitHubRepo] = synthetic.corpus(
+            random.Random(args.seed),
+            args.owners,
+            args.repos_per_owner,
+            args.releases_per_repo,
+            args.max_packages,
+        )
+    else:
+        repos = fixtures()
+    load(repos, args.batch_size, None if args.no_search else get_opensearch())
@@ -0,0 +1,73 @@
+"""flakestry.github against a fake GitHub, served through an httpx transport."""
+
+import httpx
+import pytest
+
+from flakestry.github import GitHub
+
+API_URL = "https://api.github.test"
+RAW_URL = "https://raw.github.test"
+COMMIT = {"sha": "0" * 40, "commit": {"committer": {"date": "2023-10-26T12:34:56Z"}}}
+
+
+class FakeGitHub:
+    """Serves a commit of a renamed repo and a raw README, both with ETags."""
+
+    def __init__(self):
+        self.requests: list[httpx.Request] = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if request.url.path == "/repos/owner/old-name/commits/v1.0.0":
+            return httpx.Response(
+                301, headers={"Location": f"{API_URL}/repos/owner/repo/commits/v1.0.0"}
+            )
+        if request.url.path == "/repos/owner/repo/commits/v1.0.0":
+            return self.with_etag(request, '"commit"', json=COMMIT)
+        if request.url.path == f"/owner/repo/{COMMIT['sha']}/README.md":
+            return self.with_etag(request, '"readme"', text="# Hello")
+        return httpx.Response(404)
+
+    def with_etag(self, request: httpx.Request, etag: str, **content) -> httpx.Response:
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        return httpx.Response(200, headers={"ETag": etag}, **content)
+
+
+@pytest.fixture
+def fake() -> FakeGitHub:
+    return FakeGitHub()
+
+
+@pytest.fixture
+def github(fake: FakeGitHub) -> GitHub:
+    return GitHub(
+        API_URL, RAW_URL, timeout=1, retries=0, transport=httpx.MockTransport(fake)
+    )
+
+
+def test_follows_redirects(github: GitHub, fake: FakeGitHub):
+    assert github.commit("owner", "old-name", "v1.0.0", "token") == COMMIT
+    assert [request.url.path for request in fake.requests] == [
+        "/repos/owner/old-name/commits/v1.0.0",
+        "/repos/owner/repo/commits/v1.0.0",
+    ]
+
+
+def test_caches_api_responses(github: GitHub, fake: FakeGitHub):
+    assert github.commit("owner", "repo", "v1.0.0", "token") == COMMIT
+    assert github.commit("owner", "repo", "v1.0.0", "token") == COMMIT
+    assert [request.headers.get("If-None-Match") for request in fake.requests] == [
+        None,
+        '"commit"',
+    ]
+
+
+def test_doesnt_cache_raw_files(github: GitHub, fake: FakeGitHub):
+    for _ in range(2):
+        assert github.raw("owner", "repo", COMMIT["sha"], "README.md") == "# Hello"
+    assert [request.headers.get("If-None-Match") for request in fake.requests] == [
+        None,
+        None,
+    ]
+    assert github.etags.get(f"{RAW_URL}/owner/repo/{COMMIT['sha']}/README.md") is None
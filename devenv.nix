@@ -123,8 +123,14 @@ in
       ${config.devenv.root}/frontend/generated-api/src/Api.elm
   '';
 
+  # Migrate the database schema, once per deploy
+  scripts.migrate.exec = ''
+    cd ${config.devenv.root}/backend && python -m flakestry.migrations
+  '';
+
   processes = {
-    backend.exec = "cd ${config.devenv.root} && uvicorn --app-dir backend ${lib.optionalString (!config.container.isBuilding) "--reload"} flakestry.main:app";
+    # Deploys migrate through fly's release_command
+    backend.exec = "${lib.optionalString (!config.container.isBuilding) "migrate && "}cd ${config.devenv.root} && uvicorn --app-dir backend ${lib.optionalString (!config.container.isBuilding) "--reload"} flakestry.main:app";
   } // lib.optionalAttrs (!config.container.isBuilding) {
     frontend.exec = "cd ${config.devenv.root}/frontend && elm-land server";
   };
@@ -23,6 +23,10 @@ import Octicons
 
   - `rawBaseUrl` - The base URL to use when rewriting any image URLS in the file.
 
+  - `html` - Markdown already rendered and sanitized by the API. When set, it
+    is shown instead of rendering `contents`, and only code blocks are
+    highlighted.
+
 -}
 type alias Options =
     { fileName : String
@@ -32,6 +36,7 @@ type alias Options =
     , copyableContents : Maybe String
     , baseUrl : String
     , rawBaseUrl : String
+    , html : Maybe String
     }
 
 
@@ -44,6 +49,7 @@ defaultOptions =
     , copyableContents = Nothing
     , baseUrl = ""
     , rawBaseUrl = ""
+    , html = Nothing
     }
 
 
@@ -77,6 +83,11 @@ rawBaseUrl value options =
     { options | rawBaseUrl = value }
 
 
+html : Maybe String -> Options -> Options
+html value options =
+    { options | html = value }
+
+
 setCopyableContents : Maybe String -> Options -> Options
 setCopyableContents value options =
     { options | copyableContents = value }
@@ -123,10 +134,15 @@ viewCopyButton copyableContents =
 file : Options -> Html msg
 file options =
     Html.node "highlight-code"
-        [ HA.class <| String.join " " [ "px-8 py-8 overflow-x-auto", options.class_ ]
-        , HA.attribute "code" options.contents
-        , HA.attribute "language" options.language
-        , HA.attribute "baseUrl" options.baseUrl
-        , HA.attribute "rawBaseUrl" options.rawBaseUrl
-        ]
+        ([ HA.class <| String.join " " [ "px-8 py-8 overflow-x-auto", options.class_ ]
+         , HA.attribute "code" options.contents
+         , HA.attribute "language" options.language
+         , HA.attribute "baseUrl" options.baseUrl
+         , HA.attribute "rawBaseUrl" options.rawBaseUrl
+         ]
+            ++ (options.html
+                    |> Maybe.map (\value -> [ HA.attribute "html" value ])
+                    |> Maybe.withDefault []
+               )
+        )
         []
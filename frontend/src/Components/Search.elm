@@ -72,7 +72,7 @@ update msg model =
                         _ ->
                             Effect.sendCmd <|
                                 Api.send HandleSearchResponse <|
-                                    Api.getFlakesFlakeGet model.query
+                                    Api.getFlakesFlakeGet model.query Nothing Nothing Nothing
             in
             ( model
             , searchCmd
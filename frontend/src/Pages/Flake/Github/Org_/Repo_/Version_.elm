@@ -86,12 +86,19 @@ init org repo version hash _ =
       , searchQuery = Nothing
       , releaseResponse = RemoteData.NotAsked
       }
-    , Effect.sendCmd <|
-        Api.send HandleGetRepoResponse <|
-            Api.readRepoFlakeGithubOwnerRepoGet org repo
+    , getReleases org repo Nothing
     )
 
 
+{-| A page of releases, the README is loaded with the selected release.
+-}
+getReleases : String -> String -> Maybe String -> Effect Msg
+getReleases org repo cursor =
+    Effect.sendCmd <|
+        Api.send HandleGetRepoResponse <|
+            Api.readRepoFlakeGithubOwnerRepoGet org repo cursor (Just 1000) (Just True)
+
+
 
 -- UPDATE
 
@@ -112,29 +119,56 @@ update msg model =
     case msg of
         HandleGetRepoResponse response ->
             let
+                isFirstPage =
+                    not (RemoteData.isSuccess model.repoResponse)
+
+                -- Pages are fetched one after another, following next_cursor
                 data =
-                    RemoteData.fromResult response
+                    case ( model.repoResponse, RemoteData.fromResult response ) of
+                        ( RemoteData.Success previous, RemoteData.Success repo ) ->
+                            RemoteData.Success { repo | releases = previous.releases ++ repo.releases }
+
+                        ( RemoteData.Success previous, RemoteData.Failure _ ) ->
+                            -- Keep the releases loaded so far
+                            RemoteData.Success { previous | nextCursor = Nothing }
+
+                        ( _, page_ ) ->
+                            page_
+
+                nextPage =
+                    case response of
+                        Ok repo ->
+                            Maybe.map (getReleases model.org model.repo << Just) repo.nextCursor
+
+                        Err _ ->
+                            Nothing
 
                 maybeVersion =
-                    case ( model.version, data ) of
-                        ( Just version, _ ) ->
+                    case ( isFirstPage, model.version, data ) of
+                        ( False, _, _ ) ->
+                            Nothing
+
+                        ( True, Just version, _ ) ->
                             Just version
 
-                        ( Nothing, RemoteData.Success repo ) ->
+                        ( True, Nothing, RemoteData.Success repo ) ->
                             Maybe.map .version (List.head repo.releases)
 
-                        ( Nothing, _ ) ->
+                        ( True, Nothing, _ ) ->
                             Nothing
             in
             ( { model | repoResponse = data }
-            , case maybeVersion of
-                Nothing ->
-                    Effect.none
+            , Effect.batch
+                [ Maybe.withDefault Effect.none nextPage
+                , case maybeVersion of
+                    Nothing ->
+                        Effect.none
 
-                Just version ->
-                    Effect.sendCmd <|
-                        Api.send HandleGetVersionResponse <|
-                            Api.readVersionFlakeGithubOwnerRepoVersionGet model.org model.repo version
+                    Just version ->
+                        Effect.sendCmd <|
+                            Api.send HandleGetVersionResponse <|
+                                Api.readVersionFlakeGithubOwnerRepoVersionGet model.org model.repo version Nothing
+                ]
             )
 
         HandleGetVersionResponse response ->
@@ -259,8 +293,19 @@ view model =
                         Just version ->
                             List.filter (\release -> release.version == version) repo.releases |> List.head
             in
-            case maybeRelease of
-                Nothing ->
+            case ( maybeRelease, repo.nextCursor ) of
+                ( Nothing, Just _ ) ->
+                    -- Still loading older releases
+                    { title = "flakestry - loading"
+                    , body =
+                        Flakestry.Layout.viewBody
+                            [ Flakestry.Layout.viewNav
+                            , spinner
+                            , Flakestry.Layout.viewFooter
+                            ]
+                    }
+
+                ( Nothing, Nothing ) ->
                     { title = "Flakestry - 404"
                     , body =
                         Flakestry.Layout.viewBody
@@ -270,7 +315,7 @@ view model =
                             ]
                     }
 
-                Just release ->
+                ( Just release, _ ) ->
                     { title = "Flake " ++ release.owner ++ "/" ++ release.repo
                     , body =
                         Flakestry.Layout.viewBody
@@ -495,7 +540,8 @@ viewOutputs model flakeRelease =
                             File.defaultOptions
                                 |> File.fileName "README"
                                 |> File.class "markdown-body"
-                                |> File.contents flakeRelease.readme
+                                |> File.contents (Maybe.withDefault "" release.readme)
+                                |> File.html release.readmeHtml
                                 |> File.baseUrl (baseUrl ++ "/blob/" ++ revision ++ "/")
                                 |> File.rawBaseUrl (baseUrl ++ "/raw/" ++ revision ++ "/")
                                 |> File.file
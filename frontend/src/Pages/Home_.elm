@@ -54,7 +54,7 @@ init route () =
             Effect.batch
                 [ -- Load the latest flakes
                   Effect.sendCmd <|
-                    Api.send HandleFlakesResponse (Api.getFlakesFlakeGet Nothing)
+                    Api.send HandleFlakesResponse (Api.getFlakesFlakeGet Nothing Nothing Nothing Nothing)
 
                 -- Search for flakes based on the query in the url
                 , case newSearchState.query of
@@ -18,6 +18,12 @@ window.customElements.define('highlight-code', class extends HTMLElement {
     const lang = this.getAttribute('language') ?? 'markdown';
     const baseUrl = this.getAttribute('baseUrl') ?? '';
     const rawBaseUrl = this.getAttribute('rawBaseUrl') ?? '';
+    const html = this.getAttribute('html');
+
+    if (html !== null) {
+      this.showHtml(html);
+      return;
+    }
 
     switch (lang) {
       case 'markdown':
@@ -36,6 +42,18 @@ window.customElements.define('highlight-code', class extends HTMLElement {
     this.innerHTML = sanitized;
   }
 
+  // Markdown rendered and sanitized by the API
+  showHtml(html: string) {
+    this.classList.add('block');
+    this.innerHTML = html;
+
+    this.querySelectorAll('pre code[class^="language-"]').forEach((block) => {
+      const lang = block.className.substring('language-'.length);
+      block.classList.add('hljs');
+      block.innerHTML = this.highlightCode(block.textContent ?? '', lang);
+    });
+  }
+
   async parseMarkdown(markdown: string, baseUrl = '', rawBaseUrl = '') {
     if (baseUrl) {
       this.DOMPurify.addHook('afterSanitizeAttributes', function(node) {